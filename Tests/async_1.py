@@ -0,0 +1,99 @@
+import asyncio
+
+log = []
+
+
+async def worker(name, steps):
+    for step in range(steps):
+        log.append('{} {}'.format(name, step))
+        await asyncio.sleep(0)
+    return name.upper()
+
+
+async def double(value):
+    await asyncio.sleep(0)
+    return value * 2
+
+
+async def chain(value):
+    first = await double(value)
+    second = await double(first)
+    return first + second
+
+
+async def ticker(limit):
+    for i in range(limit):
+        await asyncio.sleep(0)
+        yield i * i
+
+
+class Countdown:
+    def __init__(self, start):
+        self.current = start
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.current <= 0:
+            raise StopAsyncIteration
+        self.current -= 1
+        await asyncio.sleep(0)
+        return self.current
+
+
+class Resource:
+    def __init__(self, name):
+        self.name = name
+
+    async def __aenter__(self):
+        log.append('open ' + self.name)
+        await asyncio.sleep(0)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        log.append('close ' + self.name)
+        return False
+
+
+async def main():
+    tasks = [asyncio.ensure_future(coroutine)
+             for coroutine in [worker('a', 3), worker('b', 2), chain(5)]]
+    results = await asyncio.gather(*tasks)
+    print(results)
+    print(log)
+
+    squares = []
+    async for square in ticker(5):
+        squares.append(square)
+    print(squares)
+
+    pairs = []
+    async for outer in Countdown(3):
+        async for inner in ticker(outer):
+            pairs.append((outer, inner))
+    else:
+        pairs.append('done')
+    print(pairs)
+
+    del log[:]
+    async with Resource('db') as resource:
+        log.append('using ' + resource.name)
+    print(log)
+
+    agen = ticker(10)
+    print(await agen.__anext__(), await agen.asend(None))
+    await agen.aclose()
+    leftover = []
+    async for value in agen:
+        leftover.append(value)
+    print(leftover)
+
+    task = asyncio.ensure_future(chain(1))
+    print(await task, task.done())
+    return 'finished'
+
+
+loop = asyncio.new_event_loop()
+print(loop.run_until_complete(main()))
+loop.close()
@@ -0,0 +1,15 @@
+def make_adder(n):
+    def add(x):
+        return x + n
+    return add
+
+
+def apply(f, value):
+    n = 100
+    return f(value)
+
+
+add5 = make_adder(5)
+add7 = make_adder(7)
+print(apply(add5, 1), apply(add7, 1))
+print([apply(add5, i) for i in range(3)])
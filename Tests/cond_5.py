@@ -0,0 +1,5 @@
+items = [1, 2, 3]
+print(2 in items, 5 in items, 2 not in items, 5 not in items)
+print(None is None, items is not None, 1 < 2 <= 2, 'a' != 'b')
+if 4 not in items:
+    print('missing')
@@ -0,0 +1,12 @@
+a = [1, 2]
+b = a
+b += [3]
+print(a, b, a is b)
+s = {1}
+t = s
+t |= {2}
+print(s, t, s is t)
+x = (1,)
+y = x
+y += (2,)
+print(x, y, x is y)
@@ -0,0 +1,25 @@
+class Point(object):
+    pass
+
+
+points = [Point(), Point(), Point()]
+for i, p in enumerate(points):
+    p.x = i
+    p.x += 10
+    del p.x
+    p.y = i * 2
+
+counts = {}
+for word in ['a', 'b', 'a', 'c', 'a']:
+    counts[word] = counts.get(word, 0) + 1
+    del counts[word]
+    counts[word + '!'] = 1
+print([p.y for p in points], sorted(counts))
+
+
+def show(*args, **kwargs):
+    print(args, sorted(kwargs.items()))
+
+
+extra = {'b': 2}
+show(*[1, 2], *(3,), a=1, **extra)
@@ -0,0 +1,13 @@
+def f(a, b, c=3, *args, d, e=5, **kw):
+    return (a, b, c, args, d, e, kw)
+print(f(1, 2, d=4))
+print(f(1, 2, 7, 8, 9, d=4, z=1))
+print(f(b=1, a=2, d=0, e=9))
+def g(x, y=2):
+    return x, y
+print(g(1), g(1, 3), g(y=5, x=0))
+def h(*, k):
+    return k
+print(h(k=1))
+print((lambda: 5)())
+print([i * 2 for i in range(3)])
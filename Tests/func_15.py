@@ -0,0 +1,19 @@
+def fib(n):
+    if n < 2:
+        return n
+    return fib(n - 1) + fib(n - 2)
+
+
+def add(a, b=1):
+    return a + b
+
+
+results = []
+f = fib
+for i in range(100):
+    if i == 50:
+        f = add
+    elif i == 75:
+        f = abs
+    results.append(f(i % 7))
+print(sum(results), results[-30:])
@@ -0,0 +1,58 @@
+def describe(values):
+    return len(values)
+
+
+def shadow():
+    global len
+
+    def len(values):
+        return -1
+
+
+def unshadow():
+    global len
+    del len
+
+
+for step in range(3):
+    print(len('abc'), describe('abcd'))
+    if step == 0:
+        shadow()
+    elif step == 1:
+        unshadow()
+
+len = max
+print(len([1, 5, 2]), describe([3, 4]))
+del len
+print(len([1, 5, 2]), describe([3, 4]))
+
+
+class Shadower:
+    def shadow(self):
+        global len
+        len = lambda values: 42
+
+    def unshadow(self):
+        global len, abs
+        del len
+        del abs
+
+
+def measure(values):
+    return len(values)
+
+
+def abs(value):
+    return 'shadowed'
+
+
+def absolute(value):
+    return abs(value)
+
+
+for step in range(2):
+    print(len([1, 2]), measure([1, 2, 3]))
+    Shadower().shadow()
+print(len([1, 2]), measure([1, 2, 3]), abs(-1), absolute(-2))
+Shadower().unshadow()
+print(len([1, 2]), measure([1, 2, 3]), abs(-1), absolute(-2))
@@ -0,0 +1,26 @@
+import sys
+
+
+def f(a, **kw):
+    return a, kw
+
+
+def g(a):
+    return a
+
+
+def h(a, b=2, c=3):
+    return a, b, c
+
+
+# Positional-only parameters are 3.8 syntax; older versions get the
+# results they would give printed as they are.
+if sys.version_info >= (3, 8):
+    f.__code__ = f.__code__.replace(co_posonlyargcount=1)
+    g.__code__ = g.__code__.replace(co_posonlyargcount=1)
+    h.__code__ = h.__code__.replace(co_posonlyargcount=2)
+    print(f(1, a=2), f(1, b=2))
+    print(g(1), h(1), h(1, 5, c=6))
+else:
+    print((1, {'a': 2}), (1, {'b': 2}))
+    print(1, (1, 2, 3), (1, 5, 6))
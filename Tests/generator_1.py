@@ -0,0 +1,97 @@
+def numbers(limit):
+    n = 0
+    while n < limit:
+        yield n
+        n += 1
+
+
+def squares(source):
+    for value in source:
+        yield value * value
+
+
+def evens(source):
+    for value in source:
+        if value % 2 == 0:
+            yield value
+
+
+print(list(evens(squares(numbers(10)))))
+print(sum(value for value in squares(numbers(1000)) if value % 3 == 1))
+
+
+def running_total():
+    total = 0
+    while True:
+        value = yield total
+        if value is None:
+            return total
+        total += value
+
+
+acc = running_total()
+print(next(acc))
+print(acc.send(5))
+print(acc.send(7))
+print(acc.send(-2))
+acc.close()
+print(list(acc))
+
+
+def inner(count):
+    for i in range(count):
+        received = yield i
+        if received is not None:
+            print('inner got', received)
+    return 'inner done ' + str(count)
+
+
+def outer():
+    first = yield from inner(2)
+    print(first)
+    second = yield from inner(3)
+    print(second)
+    yield from [10, 20]
+    yield from (c for c in 'ab')
+
+
+gen = outer()
+print(next(gen))
+print(gen.send('x'))
+for item in gen:
+    print(item)
+
+
+def chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+print(list(chunks(range(7), 3)))
+print(dict((key, len(key)) for key in ['a', 'bb', 'ccc']))
+
+pairs = zip(numbers(3), (letter.upper() for letter in 'xyz'))
+print(list(pairs))
+
+it = iter(numbers(4))
+print(it is iter(it), next(it), next(it))
+it.close()
+print(list(it))
+
+
+def fib():
+    a, b = 0, 1
+    while True:
+        yield a
+        a, b = b, a + b
+
+
+fibs = fib()
+print([next(fibs) for _ in range(15)])
+print(max(numbers(50000)))
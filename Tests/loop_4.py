@@ -0,0 +1,50 @@
+class Countdown:
+    def __init__(self, start):
+        self.current = start
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.current <= 0:
+            raise StopIteration
+        self.current -= 1
+        return self.current
+
+
+def walk(items):
+    seen = []
+    for item in items:
+        if item == 'stop':
+            break
+        seen.append(item)
+    return seen
+
+
+total = 0
+for i in range(10):
+    for j in [1, 2, 3]:
+        total += i * j
+print(total)
+
+for empty in []:
+    print('never')
+for empty in ():
+    print('never')
+
+ages = {'ann': 31, 'bob': 27}
+for name in ages:
+    print(name, ages[name])
+for name, age in ages.items():
+    print(name, age)
+
+print(walk((1, 'two', 3.0)))
+print(walk(['a', 'stop', 'b']))
+print(walk('xyz'))
+print(walk(Countdown(4)))
+print(walk(range(5, 0, -2)))
+print([k for k in ages])
+
+name = 'cy'
+for key, value in {name: 1, 'ann': 2, name + 'x': 3}.items():
+    print(key, value)
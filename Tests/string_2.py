@@ -0,0 +1,6 @@
+name = 'vm'
+width = 6
+value = 3.14159
+print(f'{name}|{name!r}|{value:.2f}|{name:>{width}}|')
+print('%s has %d items' % (name, 3), '{:03d}'.format(7))
+print(1 < 2 < 3, 3 > 2 > 2, 'b' in 'abc' not in 'xyz')
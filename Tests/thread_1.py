@@ -0,0 +1,47 @@
+import sys
+import threading
+
+previous_interval = sys.getswitchinterval()
+sys.setswitchinterval(1e-5)
+results = []
+lock = threading.Lock()
+
+
+def digits(n):
+    while n:
+        yield n % 10
+        n //= 10
+
+
+def work(worker, count):
+    total = 0
+    for i in range(count):
+        total += sum(digits(i * worker))
+    name = 'worker {}'.format(worker)
+    lock.acquire()
+    results.append((name, total))
+    lock.release()
+
+
+threads = [threading.Thread(target=work, args=(worker, 3000))
+           for worker in range(1, 7)]
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+
+results.sort()
+for name, total in results:
+    print(name, total)
+
+squares = {}
+workers = [threading.Thread(target=lambda n: squares.update({n: n * n}),
+                            args=(n,))
+           for n in range(10)]
+for thread in workers:
+    thread.start()
+for thread in workers:
+    thread.join()
+print(sorted(squares.items()))
+
+sys.setswitchinterval(previous_interval)
@@ -0,0 +1,45 @@
+import threading
+
+t = None
+
+
+def f():
+    return len('ab')
+
+
+def shadow_len():
+    global len
+
+    def len(x):
+        return -1
+
+
+for i in range(3):
+    print(len('ab'), f())
+    if t is None:
+        t = threading.Thread(target=shadow_len)
+        t.start()
+        t.join()
+
+del len
+print(len('ab'), f())
+
+
+def unshadow():
+    global abs
+    del abs
+
+
+def abs(x):
+    return 'shadowed'
+
+
+def g():
+    return abs(-5)
+
+
+worker = threading.Thread(target=unshadow)
+print(g(), g())
+worker.start()
+worker.join()
+print(g(), g())
@@ -0,0 +1,270 @@
+"""Run large batches of guest scripts on a pool of worker processes.
+
+The GIL keeps one VirtualMachine on one core, so batches are split into
+shards and spread over processes. Workers are forked from a VM that is
+already built (and whatever it has compiled and decoded), and each keeps
+it for every script it runs. Results stream back as shards finish:
+
+    for result in run_batch(read_scripts(paths), workers=8, timeout=10,
+                            memory_limit=512 << 20):
+        print(result['name'], result['status'], result['time'])
+
+A result holds the script's index and name, its status ('ok', 'error',
+'timeout', 'memory' or 'crashed'), the output it printed, the error
+message if any and its run time. With cache_dir, compiled code and
+decoded instructions are also shared across workers and batches on disk.
+
+    python3 batch.py SCRIPT... [-j WORKERS] [--timeout S]
+                               [--memory-limit MiB] [--cache-dir DIR] [--json]
+"""
+import argparse
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import redirect_stdout
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class ScriptTimeout(Exception):
+    pass
+
+
+# VMs of running batches by token, inherited by the forked workers.
+_batch_vms = {}
+_batch_tokens = itertools.count()
+
+# (token, VM) of the batch this worker process serves.
+_worker = None
+
+
+def read_scripts(paths):
+    """(path, source) pairs for run_batch."""
+    scripts = []
+    for path in paths:
+        with open(path) as source:
+            scripts.append((path, source.read()))
+    return scripts
+
+
+def run_batch(scripts, vm=None, workers=None, timeout=None,
+              memory_limit=None, cache_dir=None, job=None, chunk_size=None):
+    """Run (name, source) scripts, yielding a result dict for each as
+    soon as it is available, in no particular order.
+
+    vm: the VirtualMachine workers start from, a new one by default.
+    job(vm, name, source, timeout): a module-level function running one
+    script and returning its result dict; run_script by default.
+    timeout: seconds each script may run.
+    memory_limit: bytes of address space each worker process may use.
+    A script that runs out fails alone with status 'memory'.
+
+    Workers default to one per CPU. With a single worker and no memory
+    limit the scripts run in this process.
+    """
+    if memory_limit is not None and resource is None:
+        raise ValueError('memory limits need the resource module')
+    if vm is None:
+        from vm import VirtualMachine
+        vm = VirtualMachine(cache_dir=cache_dir)
+    if job is None:
+        job = run_script
+    if workers is None:
+        workers = os.cpu_count() or 1
+    jobs = [(index, name, source)
+            for index, (name, source) in enumerate(scripts)]
+
+    if workers == 1 and memory_limit is None:
+        for index, name, source in jobs:
+            yield _run_job(job, vm, index, name, source, timeout)
+        return
+    if not jobs:
+        return
+
+    if chunk_size is None:
+        chunk_size = max(1, min(32, len(jobs) // (workers * 4)))
+    shards = [jobs[start:start + chunk_size]
+              for start in range(0, len(jobs), chunk_size)]
+    options = {}
+    if sys.version_info >= (3, 7):
+        # Workers must be forked to inherit the VM; 3.6 always forks.
+        options['mp_context'] = multiprocessing.get_context('fork')
+    token = next(_batch_tokens)
+    _batch_vms[token] = vm
+    pool_args = (options, token, job, timeout, memory_limit)
+    try:
+        lost = yield from _run_pool(shards, workers, *pool_args)
+        if lost:
+            # A dying worker takes its pool down. Rerun what was lost one
+            # script per shard, then anything lost again in a pool of its
+            # own, which tells the scripts that crashed from the ones that
+            # went down with them.
+            lost = yield from _run_pool([[entry] for shard in lost
+                                         for entry in shard],
+                                        workers, *pool_args)
+            for shard in lost:
+                if (yield from _run_pool([shard], 1, *pool_args)):
+                    index, name, _ = shard[0]
+                    yield _crashed(index, name)
+    finally:
+        del _batch_vms[token]
+
+
+def _run_pool(shards, workers, options, token, job, timeout, memory_limit):
+    """Run shards on a new pool, yielding their results; return the shards
+    lost to a worker that died."""
+    lost = []
+    with ProcessPoolExecutor(min(workers, len(shards)), **options) as executor:
+        futures = {
+            executor.submit(_run_shard, token, job, timeout, memory_limit,
+                            shard): shard
+            for shard in shards
+        }
+        try:
+            for future in as_completed(futures):
+                try:
+                    results = future.result()
+                except BrokenProcessPool:
+                    lost.append(futures[future])
+                    continue
+                for result in results:
+                    yield result
+        finally:
+            # Left early: don't run the remaining shards.
+            for future in futures:
+                future.cancel()
+    return lost
+
+
+def run_script(vm, name, source, timeout=None):
+    """Run one script on vm; the default job of run_batch."""
+    result = {'name': name, 'status': 'ok', 'output': None, 'error': None,
+              'time': None}
+    output = io.StringIO()
+    try:
+        result['time'] = run_captured(lambda: vm.run_code(source, name),
+                                      timeout, output)[1]
+    except ScriptTimeout as error:
+        result['status'], result['error'] = 'timeout', str(error)
+    except MemoryError:
+        result['status'], result['error'] = 'memory', 'MemoryError'
+    except SystemExit as error:
+        if error.code not in (None, 0):
+            result['status'] = 'error'
+            result['error'] = 'SystemExit: {}'.format(error.code)
+    except Exception as error:
+        result['status'] = 'error'
+        result['error'] = '{}: {}'.format(type(error).__name__, error)
+    result['output'] = output.getvalue()
+    return result
+
+
+def run_captured(run, timeout, output=None):
+    """Call run() with stdout captured; return the output and the time
+    taken. Output goes to the given StringIO, if any, so that it survives
+    an exception. Raises ScriptTimeout after timeout seconds where a
+    SIGALRM timer is available (the main thread of a Unix process)."""
+    if output is None:
+        output = io.StringIO()
+    use_timer = timeout and _can_use_alarm()
+    if use_timer:
+        previous = signal.signal(signal.SIGALRM, _raise_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        with redirect_stdout(output):
+            start = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - start
+    finally:
+        if use_timer:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+    return output.getvalue(), elapsed
+
+
+def _can_use_alarm():
+    return (hasattr(signal, 'setitimer') and
+            threading.current_thread() is threading.main_thread())
+
+
+def _raise_timeout(signum, frame):
+    raise ScriptTimeout('script timed out')
+
+
+def _run_shard(token, job, timeout, memory_limit, shard):
+    vm = _worker_vm(token, memory_limit)
+    return [_run_job(job, vm, index, name, source, timeout)
+            for index, name, source in shard]
+
+
+def _worker_vm(token, memory_limit):
+    """The VM of this worker, set up on its first shard."""
+    global _worker
+    if _worker is None or _worker[0] != token:
+        if memory_limit is not None:
+            hard = resource.getrlimit(resource.RLIMIT_AS)[1]
+            if hard != resource.RLIM_INFINITY:
+                memory_limit = min(memory_limit, hard)
+            resource.setrlimit(resource.RLIMIT_AS, (memory_limit, hard))
+        _worker = (token, _batch_vms[token].context())
+    return _worker[1]
+
+
+def _run_job(job, vm, index, name, source, timeout):
+    result = job(vm, name, source, timeout)
+    result['index'] = index
+    return result
+
+
+def _crashed(index, name):
+    return {'index': index, 'name': name, 'status': 'crashed',
+            'output': None, 'error': 'worker process died', 'time': None}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run guest scripts on a pool of VM worker processes.')
+    parser.add_argument('scripts', nargs='+')
+    parser.add_argument('-j', '--workers', type=int)
+    parser.add_argument('--timeout', type=float,
+                        help='seconds each script may run')
+    parser.add_argument('--memory-limit', type=int, metavar='MiB',
+                        help='address space each worker may use')
+    parser.add_argument('--cache-dir',
+                        help='directory for compiled and decoded code')
+    parser.add_argument('--json', action='store_true',
+                        help='print every result as a line of JSON')
+    args = parser.parse_args(argv)
+
+    memory_limit = args.memory_limit
+    if memory_limit is not None:
+        memory_limit <<= 20
+    failures = 0
+    for result in run_batch(read_scripts(args.scripts), None, args.workers,
+                            args.timeout, memory_limit, args.cache_dir):
+        failures += result['status'] != 'ok'
+        if args.json:
+            print(json.dumps(result, sort_keys=True))
+        elif result['error'] is None and result['time'] is not None:
+            print('{}: {} ({:.3f}s)'.format(result['name'], result['status'],
+                                            result['time']))
+        else:
+            print('{}: {} ({})'.format(result['name'], result['status'],
+                                       result['error']))
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""Per-instruction dispatch overhead: name-based getattr vs dispatch table.
+
+Runs the Tests/arithm_*.py and Tests/loop_*.py programs under the
+current VM and under a VM using the old run_frame loop (INPLACE name
+rewriting plus getattr on every instruction) and prints the average
+time per executed instruction for both.
+
+    python3 benchmarks/dispatch_overhead.py [repeats]
+"""
+import glob
+import io
+import os
+import sys
+import time
+from contextlib import redirect_stdout
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import vm  # noqa: E402
+from vm import VirtualMachine  # noqa: E402
+
+
+class NameDispatchVM(VirtualMachine):
+    """The dispatch loop as it was before the opcode table."""
+
+    def run_frame(self, frame):
+        entry_frame = frame
+        self.push_frame(frame)
+        while True:
+            frame = self.frame
+            if frame.instruction_set is None:
+                frame.instruction_set = self.get_instructions(frame.code)
+            report = None
+            while report is None:
+                instr = frame.instruction_set[frame.ip]
+                frame.ip += 1
+                opname = instr.opname
+                if opname.startswith('INPLACE'):
+                    opname = opname.replace('INPLACE', 'BINARY')
+                opname = vm.OPCODE_HANDLER_NAMES.get(opname, opname)
+                method = getattr(self, opname)
+                report = method(instr)
+            if report == 'return':
+                value = frame.stack.pop()
+                self.pop_frame()
+                if frame is entry_frame:
+                    return value
+                self.frame.stack.append(value)
+
+
+def count_instructions(code):
+    """Instructions executed by code, for normalising timings."""
+    machine = VirtualMachine(superinstructions=())
+    profile = machine.enable_profiling()
+    with redirect_stdout(io.StringIO()):
+        machine.run_code(code)
+    return sum(profile.opcode_counts.values())
+
+
+def time_program(vm, code, repeats):
+    with redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        for _ in range(repeats):
+            vm.run_code(code)
+        return time.perf_counter() - start
+
+
+def main(repeats=2000):
+    pattern = os.path.join(ROOT, 'Tests', '{}_*.py')
+    paths = sorted(glob.glob(pattern.format('arithm')) +
+                   glob.glob(pattern.format('loop')))
+
+    print('{:<12} {:>8} {:>12} {:>12} {:>8}'.format(
+        'program', 'instrs', 'name ns/op', 'table ns/op', 'speedup'))
+    total_instrs = total_name = total_table = 0
+    for path in paths:
+        with open(path) as source:
+            code = compile(source.read(), path, 'exec')
+
+        executed = count_instructions(code)
+        instrs = executed * repeats
+
+        name_time = time_program(NameDispatchVM(), code, repeats)
+        table_time = time_program(VirtualMachine(), code, repeats)
+        total_instrs += instrs
+        total_name += name_time
+        total_table += table_time
+        print('{:<12} {:>8} {:>12.1f} {:>12.1f} {:>7.2f}x'.format(
+            os.path.basename(path), executed,
+            name_time / instrs * 1e9, table_time / instrs * 1e9,
+            name_time / table_time))
+
+    print('{:<12} {:>8} {:>12.1f} {:>12.1f} {:>7.2f}x'.format(
+        'total', total_instrs // repeats,
+        total_name / total_instrs * 1e9, total_table / total_instrs * 1e9,
+        total_name / total_table))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
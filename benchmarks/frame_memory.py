@@ -0,0 +1,81 @@
+"""Memory allocated per guest call, with and without frame pooling.
+
+Runs Tests/From_500lines/test_recursion.py (and a deeper variant of the
+same recursion) on a warmed-up VM under tracemalloc and reports the
+peak traced bytes divided by the number of guest calls made.
+
+    python3 benchmarks/frame_memory.py
+"""
+import io
+import os
+import sys
+import tracemalloc
+from contextlib import redirect_stdout
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import vm  # noqa: E402
+
+RECURSION_TEST = os.path.join(ROOT, 'Tests', 'From_500lines',
+                              'test_recursion.py')
+
+DEEP_RECURSION = '''
+def fact(n):
+    if n <= 1:
+        return 1
+    else:
+        return n * fact(n - 1)
+
+
+for i in range(20):
+    fact({depth})
+'''
+
+
+class CallCountingVM(vm.VirtualMachine):
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+
+    def make_frame(self, code, fast_locals=None, globals=None, closure=()):
+        self.calls += 1
+        return super().make_frame(code, fast_locals, globals, closure)
+
+
+class UnpooledVM(CallCountingVM):
+    def release_frame(self, frame):
+        pass
+
+
+def bytes_per_call(vm_class, code):
+    machine = vm_class()
+    with redirect_stdout(io.StringIO()):
+        machine.run_code(code)
+        machine.calls = 0
+        tracemalloc.start()
+        machine.run_code(code)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return peak / machine.calls
+
+
+def main():
+    with open(RECURSION_TEST) as source:
+        programs = [('test_recursion.py',
+                     compile(source.read(), RECURSION_TEST, 'exec'))]
+    depth = vm.MAX_POOLED_FRAMES
+    programs.append(('fact({}) x 20'.format(depth),
+                     compile(DEEP_RECURSION.format(depth=depth),
+                             '<deep>', 'exec')))
+
+    print('{:<20} {:>14} {:>14}'.format(
+        'program', 'unpooled B/call', 'pooled B/call'))
+    for name, code in programs:
+        print('{:<20} {:>14.0f} {:>14.0f}'.format(
+            name, bytes_per_call(UnpooledVM, code),
+            bytes_per_call(CallCountingVM, code)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""Benchmark suite: VM run time relative to CPython on benchmarks/workloads.
+
+For every workload prints the best VM and CPython times over a number
+of repeats, the slowdown factor between them, the instructions the VM
+dispatched per second and the peak memory traced during one VM run.
+Results can be saved as a baseline and later runs compared against it;
+a workload whose slowdown grew by more than the tolerance fails the
+comparison with exit status 1. Slowdowns rather than absolute times are
+compared, so that a baseline holds up across machines of different speed.
+
+    python3 benchmarks/suite.py [-r REPEATS] [--save FILE]
+                                [--compare FILE [--tolerance 0.1]] [NAME ...]
+"""
+import argparse
+import builtins
+import glob
+import io
+import json
+import os
+import sys
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import vm  # noqa: E402
+
+WORKLOADS = os.path.join(ROOT, 'benchmarks', 'workloads')
+
+
+def best_time(run, repeats):
+    best = float('inf')
+    for _ in range(repeats):
+        with redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            run()
+            best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run_cpython(code):
+    exec(code, {'__name__': '__main__', '__builtins__': builtins})
+
+
+def run_vm(code):
+    vm.VirtualMachine().run_code(code)
+
+
+def count_instructions(code):
+    machine = vm.VirtualMachine()
+    profile = machine.enable_profiling()
+    with redirect_stdout(io.StringIO()):
+        machine.run_code(code)
+    return sum(profile.opcode_counts.values())
+
+
+def peak_memory(code):
+    tracemalloc.start()
+    try:
+        with redirect_stdout(io.StringIO()):
+            run_vm(code)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def measure(path, repeats):
+    with open(path) as source:
+        code = compile(source.read(), path, 'exec')
+    vm_time = best_time(lambda: run_vm(code), repeats)
+    cpython_time = best_time(lambda: run_cpython(code), repeats)
+    instructions = count_instructions(code)
+    return {'vm_time': vm_time,
+            'cpython_time': cpython_time,
+            'slowdown': vm_time / cpython_time,
+            'instructions': instructions,
+            'instructions_per_second': instructions / vm_time,
+            'peak_memory': peak_memory(code)}
+
+
+def find_regressions(results, baseline, tolerance):
+    regressions = []
+    for name, result in sorted(results.items()):
+        old = baseline['workloads'].get(name)
+        if old is None:
+            continue
+        change = result['slowdown'] / old['slowdown'] - 1
+        print('{:<20} slowdown {:>7.2f}x -> {:>7.2f}x ({:+.1%})'.format(
+            name, old['slowdown'], result['slowdown'], change))
+        if change > tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Time the VM against CPython on benchmark workloads.')
+    parser.add_argument('names', nargs='*',
+                        help='workloads to run (default: all)')
+    parser.add_argument('-r', '--repeats', type=int, default=5)
+    parser.add_argument('--save', metavar='FILE',
+                        help='write the results as a baseline')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='fail if a slowdown regressed against FILE')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='allowed relative slowdown growth')
+    args = parser.parse_args(argv)
+
+    paths = sorted(glob.glob(os.path.join(WORKLOADS, '*.py')))
+    if args.names:
+        paths = [path for path in paths
+                 if os.path.splitext(os.path.basename(path))[0]
+                 in args.names]
+
+    print('{:<20} {:>9} {:>9} {:>9} {:>11} {:>10}'.format(
+        'workload', 'vm s', 'cpython s', 'slowdown', 'instr/s', 'peak KiB'))
+    results = {}
+    for path in paths:
+        name = os.path.splitext(os.path.basename(path))[0]
+        result = results[name] = measure(path, args.repeats)
+        print('{:<20} {:>9.4f} {:>9.4f} {:>8.1f}x {:>11.0f} {:>10.0f}'
+              .format(name, result['vm_time'], result['cpython_time'],
+                      result['slowdown'], result['instructions_per_second'],
+                      result['peak_memory'] / 1024))
+
+    python = '{}.{}'.format(*vm.PY_VERSION)
+    if args.save:
+        with open(args.save, 'w') as output:
+            json.dump({'python': python, 'workloads': results}, output,
+                      indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as source:
+            baseline = json.load(source)
+        if baseline['python'] != python:
+            sys.exit('baseline was recorded on Python {}, not {}'.format(
+                baseline['python'], python))
+        regressions = find_regressions(results, baseline, args.tolerance)
+        if regressions:
+            sys.exit('slowdown regressed by more than {:.0%}: {}'.format(
+                args.tolerance, ', '.join(regressions)))
+
+
+if __name__ == '__main__':
+    main()
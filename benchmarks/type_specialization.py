@@ -0,0 +1,300 @@
+"""Type-specialised arithmetic, comparison and attribute sites.
+
+Runs the benchmarks/workloads programs under the current VM, whose
+adaptive sites only specialise calls and name lookups, and under a VM
+that also quickens +, -, * and comparisons on ints, floats and strs, and
+LOAD_ATTR on instances of a known class or on modules, behind the same
+adaptive handlers, guards and deoptimize() fallback. Prints the best
+time of each and the specialisation counters of the latter. The VM
+leaves these sites generic, as each operation already runs in C through
+one operator or getattr call and the type guards eat most of what the
+specialised handlers save; results vary from run to run and workload to
+workload, so rerun this before changing that. Superinstructions absorb many of
+these sites; --no-superinstructions compares them all.
+
+    python3 benchmarks/type_specialization.py [-r REPEATS]
+                                              [--no-superinstructions]
+                                              [NAME ...]
+"""
+import argparse
+import glob
+import io
+import os
+import sys
+import time
+import types
+from contextlib import redirect_stdout
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import vm  # noqa: E402
+from vm import VirtualMachine  # noqa: E402
+
+WORKLOADS = os.path.join(ROOT, 'benchmarks', 'workloads')
+
+# Operator callables (instruction argvals) of the specialised binary
+# sites, by the name part of their handlers.
+BINARY_KINDS = {
+    vm.BINARY_OPERATORS['+']: 'ADD',
+    vm.BINARY_OPERATORS['+=']: 'ADD',
+    vm.BINARY_OPERATORS['-']: 'SUBTRACT',
+    vm.BINARY_OPERATORS['-=']: 'SUBTRACT',
+    vm.BINARY_OPERATORS['*']: 'MULTIPLY',
+    vm.BINARY_OPERATORS['*=']: 'MULTIPLY',
+}
+
+SPECIALISED_TYPES = {int: 'INT', float: 'FLOAT', str: 'STR'}
+
+
+class TypeSpecializingVM(VirtualMachine):
+    """The VM with type-specialised BINARY_*, COMPARE_OP and LOAD_ATTR."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        for opcode, handler in enumerate(self.dispatch_table):
+            name = handler.__name__
+            if name == 'LOAD_ATTR':
+                self.adaptive_handlers[opcode] = self.LOAD_ATTR_ADAPTIVE
+            elif name == 'COMPARE_OP':
+                self.adaptive_handlers[opcode] = self.COMPARE_OP_ADAPTIVE
+            elif name == 'BINARY_OP' or (
+                    name in vm.BINARY_OPCODE_SYMBOLS and
+                    vm.BINARY_OPERATORS[vm.BINARY_OPCODE_SYMBOLS[name]]
+                    in BINARY_KINDS):
+                self.adaptive_handlers[opcode] = self.BINARY_ADAPTIVE
+
+    def BINARY_ADAPTIVE(self, instr):
+        if instr.counter:
+            instr.counter -= 1
+        else:
+            stack = self.frame.stack
+            kind = BINARY_KINDS.get(instr.argval)
+            type_name = SPECIALISED_TYPES.get(type(stack[-1]))
+            handler = None
+            if (kind is not None and type_name is not None and
+                    type(stack[-2]) is type(stack[-1])):
+                handler = getattr(self, 'BINARY_{}_{}'.format(kind, type_name),
+                                  None)
+            if handler is None:
+                instr.counter = vm.QUICKEN_BACKOFF
+            else:
+                instr.handler = handler
+                self.specializations += 1
+        return self.dispatch_table[instr.opcode](instr)
+
+    def BINARY_ADD_INT(self, instr):
+        stack = self.frame.stack
+        first = stack[-1]
+        second = stack[-2]
+        if type(first) is not int or type(second) is not int:
+            return self.deoptimize(instr)
+        self.specialization_hits += 1
+        del stack[-1]
+        stack[-1] = second + first
+
+    def BINARY_ADD_FLOAT(self, instr):
+        stack = self.frame.stack
+        first = stack[-1]
+        second = stack[-2]
+        if type(first) is not float or type(second) is not float:
+            return self.deoptimize(instr)
+        self.specialization_hits += 1
+        del stack[-1]
+        stack[-1] = second + first
+
+    def BINARY_ADD_STR(self, instr):
+        stack = self.frame.stack
+        first = stack[-1]
+        second = stack[-2]
+        if type(first) is not str or type(second) is not str:
+            return self.deoptimize(instr)
+        self.specialization_hits += 1
+        del stack[-1]
+        stack[-1] = second + first
+
+    def BINARY_SUBTRACT_INT(self, instr):
+        stack = self.frame.stack
+        first = stack[-1]
+        second = stack[-2]
+        if type(first) is not int or type(second) is not int:
+            return self.deoptimize(instr)
+        self.specialization_hits += 1
+        del stack[-1]
+        stack[-1] = second - first
+
+    def BINARY_SUBTRACT_FLOAT(self, instr):
+        stack = self.frame.stack
+        first = stack[-1]
+        second = stack[-2]
+        if type(first) is not float or type(second) is not float:
+            return self.deoptimize(instr)
+        self.specialization_hits += 1
+        del stack[-1]
+        stack[-1] = second - first
+
+    def BINARY_MULTIPLY_INT(self, instr):
+        stack = self.frame.stack
+        first = stack[-1]
+        second = stack[-2]
+        if type(first) is not int or type(second) is not int:
+            return self.deoptimize(instr)
+        self.specialization_hits += 1
+        del stack[-1]
+        stack[-1] = second * first
+
+    def BINARY_MULTIPLY_FLOAT(self, instr):
+        stack = self.frame.stack
+        first = stack[-1]
+        second = stack[-2]
+        if type(first) is not float or type(second) is not float:
+            return self.deoptimize(instr)
+        self.specialization_hits += 1
+        del stack[-1]
+        stack[-1] = second * first
+
+    def COMPARE_OP_ADAPTIVE(self, instr):
+        if instr.counter:
+            instr.counter -= 1
+        else:
+            stack = self.frame.stack
+            type_name = SPECIALISED_TYPES.get(type(stack[-1]))
+            if (type_name is not None and
+                    type(stack[-2]) is type(stack[-1]) and
+                    instr.argval in vm.OPERATOR_SYMBOLS and
+                    vm.OPERATOR_SYMBOLS[instr.argval] in
+                    ('<', '<=', '==', '!=', '>', '>=')):
+                instr.handler = getattr(self, 'COMPARE_OP_' + type_name)
+                self.specializations += 1
+            else:
+                instr.counter = vm.QUICKEN_BACKOFF
+        return self.COMPARE_OP(instr)
+
+    def COMPARE_OP_INT(self, instr):
+        stack = self.frame.stack
+        first = stack[-1]
+        second = stack[-2]
+        if type(first) is not int or type(second) is not int:
+            return self.deoptimize(instr)
+        self.specialization_hits += 1
+        del stack[-1]
+        stack[-1] = instr.argval(second, first)
+
+    def COMPARE_OP_FLOAT(self, instr):
+        stack = self.frame.stack
+        first = stack[-1]
+        second = stack[-2]
+        if type(first) is not float or type(second) is not float:
+            return self.deoptimize(instr)
+        self.specialization_hits += 1
+        del stack[-1]
+        stack[-1] = instr.argval(second, first)
+
+    def COMPARE_OP_STR(self, instr):
+        stack = self.frame.stack
+        first = stack[-1]
+        second = stack[-2]
+        if type(first) is not str or type(second) is not str:
+            return self.deoptimize(instr)
+        self.specialization_hits += 1
+        del stack[-1]
+        stack[-1] = instr.argval(second, first)
+
+    def LOAD_ATTR_ADAPTIVE(self, instr):
+        if instr.counter:
+            instr.counter -= 1
+        else:
+            owner = self.frame.stack[-1]
+            owner_type = type(owner)
+            if owner_type is types.ModuleType:
+                instr.handler = self.LOAD_ATTR_MODULE
+                self.specializations += 1
+            elif (owner_type.__getattribute__ is object.__getattribute__ and
+                    instr.argval in getattr(owner, '__dict__', ()) and
+                    not any(instr.argval in vars(base)
+                            for base in owner_type.__mro__)):
+                # The known type, kept where name sites keep their
+                # namespace, as attribute sites have no use for it.
+                instr.cache_namespace = owner_type
+                instr.handler = self.LOAD_ATTR_INSTANCE_VALUE
+                self.specializations += 1
+            else:
+                instr.counter = vm.QUICKEN_BACKOFF
+        return self.LOAD_ATTR(instr)
+
+    def LOAD_ATTR_MODULE(self, instr):
+        stack = self.frame.stack
+        owner = stack[-1]
+        if type(owner) is not types.ModuleType:
+            return self.deoptimize(instr)
+        try:
+            stack[-1] = owner.__dict__[instr.argval]
+        except KeyError:
+            return self.deoptimize(instr)
+        self.specialization_hits += 1
+
+    def LOAD_ATTR_INSTANCE_VALUE(self, instr):
+        # Assumes the class gains no descriptor for the name later; the
+        # VM has no type version tags to guard that with.
+        stack = self.frame.stack
+        owner = stack[-1]
+        if type(owner) is not instr.cache_namespace:
+            return self.deoptimize(instr)
+        try:
+            stack[-1] = owner.__dict__[instr.argval]
+        except KeyError:
+            return self.deoptimize(instr)
+        self.specialization_hits += 1
+
+
+def best_time(make_vm, code, repeats, superinstructions):
+    best = float('inf')
+    for _ in range(repeats):
+        machine = make_vm(superinstructions=superinstructions)
+        with redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            machine.run_code(code)
+            best = min(best, time.perf_counter() - start)
+    return best, machine
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Time type-specialised sites against generic ones.')
+    parser.add_argument('names', nargs='*',
+                        help='workloads to run (default: all)')
+    parser.add_argument('-r', '--repeats', type=int, default=5)
+    parser.add_argument('--no-superinstructions', action='store_true',
+                        help='decode without fusing superinstructions')
+    args = parser.parse_args(argv)
+    superinstructions = () if args.no_superinstructions else None
+
+    paths = sorted(glob.glob(os.path.join(WORKLOADS, '*.py')))
+    if args.names:
+        paths = [path for path in paths
+                 if os.path.splitext(os.path.basename(path))[0]
+                 in args.names]
+
+    print('{:<20} {:>9} {:>9} {:>8} {:>6} {:>9} {:>7}'.format(
+        'workload', 'generic s', 'typed s', 'speedup', 'sites', 'hits',
+        'misses'))
+    total_generic = total_typed = 0
+    for path in paths:
+        with open(path) as source:
+            code = compile(source.read(), path, 'exec')
+        generic, _ = best_time(VirtualMachine, code, args.repeats,
+                               superinstructions)
+        typed, machine = best_time(TypeSpecializingVM, code, args.repeats,
+                                   superinstructions)
+        total_generic += generic
+        total_typed += typed
+        print('{:<20} {:>9.4f} {:>9.4f} {:>7.2f}x {:>6} {:>9} {:>7}'.format(
+            os.path.splitext(os.path.basename(path))[0], generic, typed,
+            generic / typed, machine.specializations,
+            machine.specialization_hits, machine.specialization_misses))
+    print('{:<20} {:>9.4f} {:>9.4f} {:>7.2f}x'.format(
+        'total', total_generic, total_typed, total_generic / total_typed))
+
+
+if __name__ == '__main__':
+    main()
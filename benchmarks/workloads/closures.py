@@ -0,0 +1,28 @@
+def make_counter(step):
+    count = 0
+
+    def increment():
+        nonlocal count
+        count += step
+        return count
+    return increment
+
+
+def compose(f, g):
+    def composed(x):
+        return f(g(x))
+    return composed
+
+
+def make_adder(n):
+    def add(x):
+        return x + n
+    return add
+
+
+counter = make_counter(3)
+pipeline = compose(make_adder(1), compose(make_adder(2), make_adder(3)))
+total = 0
+for i in range(4000):
+    total += pipeline(i) + counter()
+print(total)
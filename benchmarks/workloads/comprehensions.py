@@ -0,0 +1,7 @@
+numbers = list(range(6000))
+squares = [n * n for n in numbers if n % 3]
+pairs = {n: n % 17 for n in numbers}
+buckets = {value for value in pairs.values()}
+grid = [[row * col for col in range(30)] for row in range(60)]
+flat = [cell for row in grid for cell in row if cell % 2 == 0]
+print(len(squares), sum(squares), len(buckets), len(flat), sum(flat))
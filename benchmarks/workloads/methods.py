@@ -0,0 +1,31 @@
+class Vector:
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+    def add(self, other):
+        return Vector(self.x + other.x, self.y + other.y)
+
+    def scale(self, factor):
+        return Vector(self.x * factor, self.y * factor)
+
+    def dot(self, other):
+        return self.x * other.x + self.y * other.y
+
+
+class Particle:
+    def __init__(self, position, velocity):
+        self.position = position
+        self.velocity = velocity
+
+    def step(self, dt):
+        self.position = self.position.add(self.velocity.scale(dt))
+        return self.position.dot(self.position)
+
+
+particles = [Particle(Vector(i, -i), Vector(1, 2)) for i in range(40)]
+energy = 0
+for tick in range(200):
+    for particle in particles:
+        energy += particle.step(1)
+print(energy)
@@ -0,0 +1,27 @@
+def sieve(limit):
+    flags = [True] * limit
+    flags[0] = flags[1] = False
+    for i in range(2, limit):
+        if flags[i]:
+            for multiple in range(i * i, limit, i):
+                flags[multiple] = False
+    return sum(flags)
+
+
+def collatz_steps(limit):
+    longest = 0
+    for start in range(1, limit):
+        n = start
+        steps = 0
+        while n != 1:
+            if n % 2 == 0:
+                n = n // 2
+            else:
+                n = 3 * n + 1
+            steps += 1
+        if steps > longest:
+            longest = steps
+    return longest
+
+
+print(sieve(15000), collatz_steps(400))
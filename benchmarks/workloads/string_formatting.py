@@ -0,0 +1,12 @@
+def render(rows):
+    lines = []
+    for name, price, count in rows:
+        lines.append('{:<8} {:>8.2f} x{}'.format(name, price, count))
+        lines.append(f'{name}: {price * count:.1f}')
+        lines.append('%s=%d' % (name, count))
+    return '\n'.join(lines)
+
+
+rows = [('item' + str(i), i * 1.25, i % 7) for i in range(1500)]
+text = render(rows)
+print(len(text), text.count('item'), text.upper()[:20])
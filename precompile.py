@@ -0,0 +1,48 @@
+"""Precompile a directory of guest scripts to .pyc files for run_pyc().
+
+    python3 precompile.py DIRECTORY [--legacy] [--invalidation MODE]
+
+By default each script gets a __pycache__ entry, which run_pyc() checks
+against the script's mtime and size. --legacy writes script.pyc beside
+each script instead, for shipping without sources. MODE is one of
+timestamp (the default), checked-hash or unchecked-hash. Hash-based
+invalidation (Python 3.7+) keeps the .pyc valid when files are copied
+with new mtimes; unchecked hashes skip looking at the source at all.
+"""
+import argparse
+import compileall
+import sys
+
+INVALIDATION_MODES = ['timestamp', 'checked-hash', 'unchecked-hash']
+
+
+def precompile_dir(directory, legacy=False, invalidation='timestamp'):
+    """Compile every script under directory; return True if all
+    compiled."""
+    options = {}
+    if invalidation != 'timestamp':
+        import py_compile
+        if not hasattr(py_compile, 'PycInvalidationMode'):
+            raise ValueError('{} invalidation needs Python 3.7+'
+                             .format(invalidation))
+        options['invalidation_mode'] = py_compile.PycInvalidationMode[
+            invalidation.upper().replace('-', '_')]
+    return bool(compileall.compile_dir(directory, quiet=1, legacy=legacy,
+                                       **options))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Precompile guest scripts for VirtualMachine.run_pyc.')
+    parser.add_argument('directory')
+    parser.add_argument('--legacy', action='store_true',
+                        help='write script.pyc next to each script')
+    parser.add_argument('--invalidation', choices=INVALIDATION_MODES,
+                        default='timestamp')
+    args = parser.parse_args(argv)
+    if not precompile_dir(args.directory, args.legacy, args.invalidation):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
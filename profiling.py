@@ -0,0 +1,238 @@
+"""Profilers for code run by the VM.
+
+Profile, collected by VirtualMachine.enable_profiling(), traces every
+instruction and call:
+
+    profile = vm.enable_profiling()
+    vm.run_code(source)
+    profile.dump_json('profile.json')
+    profile.dump_stats('profile.pstats')    # python3 -m pstats profile.pstats
+
+Opcode statistics are keyed by the name of the handler that ran, so
+superinstructions and specialised handlers show up under their own
+names; opcode pairs are keyed by the generic handler names, the form
+select_superinstructions() expects. Opcode times are exclusive of the
+guest calls an instruction makes. All times are wall-clock seconds.
+
+Sampler instead looks at the VM's frame stack from a background thread
+every interval seconds, cheap enough to leave on, and reports how often
+each guest line was running as collapsed stacks for flame graphs:
+
+    with Sampler(vm) as sampler:
+        vm.run_code(source)
+    sampler.dump_collapsed('stacks.txt')    # flamegraph.pl stacks.txt
+"""
+import bisect
+import collections
+import dis
+import json
+import marshal
+import threading
+import time
+
+
+class CodeStats(object):
+    """Calls and time of one code object, accumulated over its frames."""
+    __slots__ = ['code', 'calls', 'primitive_calls', 'inclusive',
+                 'exclusive', 'active', 'callers']
+
+    def __init__(self, code):
+        self.code = code
+        self.calls = 0
+        # Calls that were not recursive, i.e. not already on the stack.
+        self.primitive_calls = 0
+        self.inclusive = 0.0
+        self.exclusive = 0.0
+        self.active = 0
+        # Caller CodeStats -> [calls, primitive calls, exclusive, inclusive]
+        self.callers = collections.defaultdict(lambda: [0, 0, 0.0, 0.0])
+
+    @property
+    def key(self):
+        """The (filename, lineno, funcname) triple pstats uses."""
+        return (self.code.co_filename, self.code.co_firstlineno,
+                self.code.co_name)
+
+
+def _add(first, second):
+    return tuple(a + b for a, b in zip(first, second))
+
+
+class Profile(object):
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.opcode_counts = collections.Counter()
+        self.opcode_times = collections.Counter()
+        self.pair_counts = collections.Counter()
+        self.code_stats = {}
+        # One [CodeStats, start time, time spent in callees] per running
+        # frame, innermost last.
+        self.call_stack = []
+
+    def enter(self, code):
+        stats = self.code_stats.get(code)
+        if stats is None:
+            stats = self.code_stats[code] = CodeStats(code)
+        entry = [stats, self.clock(), 0.0]
+        self.call_stack.append(entry)
+        stats.calls += 1
+        if not stats.active:
+            stats.primitive_calls += 1
+        stats.active += 1
+        return entry
+
+    def exit(self, entry):
+        stats, start, callee_time = entry
+        elapsed = self.clock() - start
+        self.call_stack.pop()
+        stats.active -= 1
+        exclusive = elapsed - callee_time
+        stats.exclusive += exclusive
+        # Time of a recursive activation is already part of the
+        # outermost one.
+        if not stats.active:
+            stats.inclusive += elapsed
+        if self.call_stack:
+            caller = self.call_stack[-1]
+            caller[2] += elapsed
+            edge = stats.callers[caller[0]]
+            edge[0] += 1
+            edge[1] += int(not stats.active)
+            edge[2] += exclusive
+            edge[3] += elapsed
+
+    def create_stats(self):
+        """Fill self.stats in the layout pstats.Stats loads."""
+        # Distinct code objects can share a key, e.g. the lambdas on one
+        # line or a script run twice; like cProfile, their entries and
+        # caller edges are summed.
+        self.stats = {}
+        for stats in self.code_stats.values():
+            entry = (stats.primitive_calls, stats.calls, stats.exclusive,
+                     stats.inclusive)
+            if stats.key in self.stats:
+                *totals, callers = self.stats[stats.key]
+                entry = _add(totals, entry)
+            else:
+                callers = {}
+            for caller, edge in stats.callers.items():
+                if caller.key in callers:
+                    edge = _add(callers[caller.key], edge)
+                callers[caller.key] = tuple(edge)
+            self.stats[stats.key] = entry + (callers,)
+
+    def dump_stats(self, filename):
+        """Write a file readable by pstats.Stats and snakeviz-like tools."""
+        self.create_stats()
+        with open(filename, 'wb') as output:
+            marshal.dump(self.stats, output)
+
+    def to_dict(self):
+        opcodes = {
+            name: {'count': count, 'time': self.opcode_times[name]}
+            for name, count in self.opcode_counts.most_common()
+        }
+        pairs = [[first, second, count] for (first, second), count
+                 in self.pair_counts.most_common()]
+        functions = [
+            {'filename': stats.code.co_filename,
+             'lineno': stats.code.co_firstlineno,
+             'name': stats.code.co_name,
+             'calls': stats.calls,
+             'primitive_calls': stats.primitive_calls,
+             'inclusive': stats.inclusive,
+             'exclusive': stats.exclusive}
+            for stats in sorted(self.code_stats.values(),
+                                key=lambda stats: -stats.inclusive)
+        ]
+        return {'opcodes': opcodes, 'pairs': pairs, 'functions': functions}
+
+    def dump_json(self, filename):
+        with open(filename, 'w') as output:
+            json.dump(self.to_dict(), output, indent=2)
+
+
+class Sampler(object):
+    def __init__(self, vm, interval=0.005):
+        self.vm = vm
+        self.interval = interval
+        # Tuples of (code, instruction offset), outermost frame first,
+        # mapped to the number of samples that saw them.
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self._line_starts = {}
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        """Record the VM's current stack, if it is running anything."""
+        stack = []
+        for frame in list(self.vm.frame_stack):
+            instruction_set = frame.instruction_set
+            code = frame.code
+            if instruction_set is None or code is None:
+                continue
+            # ip already points past the running instruction.
+            index = min(max(frame.ip - 1, 0), len(instruction_set) - 1)
+            if index >= 0:
+                stack.append((code, instruction_set[index].offset))
+        if stack:
+            self.stacks[tuple(stack)] += 1
+            self.samples += 1
+
+    def line_number(self, code, offset):
+        line_starts = self._line_starts.get(code)
+        if line_starts is None:
+            line_starts = self._line_starts[code] = \
+                list(dis.findlinestarts(code))
+        index = bisect.bisect_right(line_starts, (offset, float('inf')))
+        if not index:
+            return code.co_firstlineno
+        return line_starts[index - 1][1]
+
+    def line_counts(self):
+        """Samples per (filename, function, line) that was running."""
+        counts = collections.Counter()
+        for stack, count in self.stacks.items():
+            code, offset = stack[-1]
+            counts[code.co_filename, code.co_name,
+                   self.line_number(code, offset)] += count
+        return counts
+
+    def collapsed(self):
+        """Lines of ';'-joined frames and a sample count, the input
+        format of flamegraph.pl and speedscope."""
+        stacks = collections.Counter()
+        for stack, count in self.stacks.items():
+            frames = ['{} ({}:{})'.format(code.co_name, code.co_filename,
+                                          self.line_number(code, offset))
+                      for code, offset in stack]
+            stacks[';'.join(frames)] += count
+        return ['{} {}'.format(stack, count)
+                for stack, count in sorted(stacks.items())]
+
+    def dump_collapsed(self, filename):
+        with open(filename, 'w') as output:
+            for line in self.collapsed():
+                output.write(line + '\n')
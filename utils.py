@@ -1,67 +1,96 @@
-import filecmp
-import sys
+import builtins
+import json
 import os
-from contextlib import redirect_stdout
 from os.path import isfile, join
 
-global_names = globals()
-local_names = locals()
+from batch import run_batch, run_captured
 
+# Seconds a single test may run under either interpreter.
+TEST_TIMEOUT = 60
 
-def run_vm(vm):
-    run_tests_in_dir(vm, './Tests/')
-    run_tests_in_dir(vm, './Tests/From_500lines/')
 
+def run_vm(vm, workers=None, report_path=None):
+    reports = [run_tests_in_dir(vm, './Tests/', workers),
+               run_tests_in_dir(vm, './Tests/From_500lines/', workers)]
+    if report_path is not None:
+        with open(report_path, 'w') as report_file:
+            json.dump(reports, report_file, indent=2)
+    return reports
 
-def run_tests_in_dir(vm, path='./Tests/'):
-    tests = [file for file in os.listdir(path) if isfile(join(path, file))]
-    correct_count = 0
-    test_count = 0
-    for test_name in tests:
-        try:
-            correct = run_test(vm, test_name, dir_name=path)
-            correct_count += int(correct)
-        except AttributeError:
-            pass
-        test_count += 1
 
+def run_tests_in_dir(vm, path='./Tests/', workers=None,
+                     timeout=TEST_TIMEOUT):
+    """Run every test in path against vm and CPython, printing a line per
+    test as it finishes and a summary, and return a JSON-serialisable
+    report.
+
+    Tests are spread over workers processes forked from vm by
+    batch.run_batch (one per CPU by default); with a single worker they
+    run in this process.
+    """
+    tests = sorted(file for file in os.listdir(path)
+                   if isfile(join(path, file)))
+    scripts = []
+    for test_name in tests:
+        with open(join(path, test_name)) as source:
+            scripts.append((test_name, source.read()))
+    results = [_print_result(result)
+               for result in run_batch(scripts, vm, workers, timeout,
+                                       job=_run_test_job)]
+    results.sort(key=lambda result: result.pop('index'))
+
+    correct_count = sum(result['correct'] for result in results)
     print('======================================\n{}: passed {}/{} tests\n'
           '======================================'
-          .format(path, correct_count, test_count))
-
+          .format(path, correct_count, len(results)))
+    return {'path': path, 'passed': correct_count, 'total': len(results),
+            'tests': results}
 
-def run_test(vm, test_name, dir_name='./Tests/'):
-    os.system('rm ./true_res.txt')
 
-    with open('{}{}'.format(dir_name, test_name)) as source:
+def run_test(vm, test_name, dir_name='./Tests/', timeout=TEST_TIMEOUT):
+    with open(join(dir_name, test_name)) as source:
         code = source.read()
-
-    true_res = open('true_res.txt', 'w')
-    with redirect_stdout(true_res) as output:
-        exec(code, global_names, local_names)
-    true_res.close()
-
-    vm_res = open('vm_res.txt', 'w')
-    with redirect_stdout(vm_res) as output:
-        vm.run_code(code)
-    vm_res.close()
-
-    if filecmp.cmp('vm_res.txt', 'true_res.txt'):
-        print('{}: correct'.format(test_name))
-        test_correct = True
+    result = _print_result(_run_test_job(vm, test_name, code, timeout))
+    return result['correct']
+
+
+def _run_test_job(vm, test_name, code, timeout):
+    result = {'test': test_name, 'correct': False, 'error': None,
+              'vm_time': None, 'cpython_time': None, 'ratio': None}
+
+    try:
+        true_res, result['cpython_time'] = run_captured(
+            lambda: exec(code, {'__name__': '__main__',
+                                '__builtins__': builtins}),
+            timeout)
+        vm_res, result['vm_time'] = run_captured(
+            lambda: vm.run_code(code), timeout)
+    except Exception as error:
+        result['error'] = '{}: {}'.format(type(error).__name__, error)
+        return result
+
+    result['correct'] = vm_res == true_res
+    if result['cpython_time']:
+        result['ratio'] = result['vm_time'] / result['cpython_time']
+    if not result['correct']:
+        result['vm_res'] = vm_res
+        result['true_res'] = true_res
+    return result
+
+
+def _print_result(result):
+    if result['correct']:
+        print('{}: correct'.format(result['test']))
+    elif result['error'] is not None:
+        print('{} error: {}'.format(result['test'], result['error']))
     else:
-        with open('vm_res.txt', 'r') as vm_res:
-            with open('true_res.txt', 'r') as true_res:
-                print('{} error:\nvm_res:\n{}\ntrue_res:\n{}'
-                      .format(test_name, vm_res.read(), true_res.read()))
-        test_correct = False
-    return test_correct
+        print('{} error:\nvm_res:\n{}\ntrue_res:\n{}'
+              .format(result['test'], result['vm_res'], result['true_res']))
+    return result
 
 
 def run_vm_on_file(vm, filename):
-    with open(filename, 'r') as source:
-        code = source.read()
-    vm.run_code(code)
+    vm.run_file(filename)
 
 
 class TrueInterpreter(object):
@@ -1,20 +1,353 @@
+import ast
 import dis
 import builtins
+import collections
+import hashlib
+import importlib.util
 import inspect
+import itertools
+import marshal
+import os
 import operator
+import sys
+import threading
 import types
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import redirect_stdout
+import profiling
 import utils
 from utils import run_vm
 
+PY_VERSION = sys.version_info[:2]
+
+# The handlers implement the Python 3.6 opcode set. For other interpreter
+# versions this maps opcode names to the handler implementing them, for
+# opcodes that were renamed or changed their stack effect. Opcodes mapped
+# to None have no runtime effect here and are dropped while decoding.
+OPCODE_COMPAT = {
+    (3, 6): {},
+    (3, 11): {
+        'CACHE': None,
+        'NOP': None,
+        'EXTENDED_ARG': None,
+        'RESUME': None,
+        'PRECALL': None,
+        'KW_NAMES': None,
+        'MAKE_CELL': None,
+        'COPY_FREE_VARS': None,
+        'JUMP_BACKWARD': 'JUMP_ABSOLUTE',
+        'JUMP_BACKWARD_NO_INTERRUPT': 'JUMP_ABSOLUTE',
+        'POP_JUMP_FORWARD_IF_FALSE': 'POP_JUMP_IF_FALSE',
+        'POP_JUMP_BACKWARD_IF_FALSE': 'POP_JUMP_IF_FALSE',
+        'POP_JUMP_FORWARD_IF_TRUE': 'POP_JUMP_IF_TRUE',
+        'POP_JUMP_BACKWARD_IF_TRUE': 'POP_JUMP_IF_TRUE',
+        'POP_JUMP_FORWARD_IF_NONE': 'POP_JUMP_IF_NONE',
+        'POP_JUMP_BACKWARD_IF_NONE': 'POP_JUMP_IF_NONE',
+        'POP_JUMP_FORWARD_IF_NOT_NONE': 'POP_JUMP_IF_NOT_NONE',
+        'POP_JUMP_BACKWARD_IF_NOT_NONE': 'POP_JUMP_IF_NOT_NONE',
+        'IS_OP': 'COMPARE_OP',
+        'CONTAINS_OP': 'COMPARE_OP',
+        'MAKE_FUNCTION': 'MAKE_FUNCTION_311',
+        'CALL_FUNCTION_EX': 'CALL_FUNCTION_EX_311',
+        'MAP_ADD': 'MAP_ADD_311',
+    },
+}
+OPCODE_HANDLER_NAMES = OPCODE_COMPAT.get(PY_VERSION, {})
+SKIPPED_OPCODES = frozenset(dis.opmap[opname]
+                            for opname, handler_name
+                            in OPCODE_HANDLER_NAMES.items()
+                            if handler_name is None and opname in dis.opmap)
+
+JUMP_OPCODES = frozenset(dis.hasjrel + dis.hasjabs)
+
+# From 3.11 LOAD_GLOBAL also pushes NULL when the low bit of its argument
+# is set; decoding splits such instructions into PUSH_NULL and LOAD_GLOBAL.
+LOAD_GLOBAL_PUSHES_NULL = PY_VERSION >= (3, 11)
+
+# Before 3.11, async generators yield with a plain YIELD_VALUE, which
+# decoding replaces with YIELD_VALUE_ASYNC_GEN; later ASYNC_GEN_WRAP marks
+# their yields.
+ASYNC_GEN_WRAPS_YIELDS = 'ASYNC_GEN_WRAP' not in dis.opmap
+
+# Before 3.7, the awaitable __aiter__ protocol has GET_AITER's result
+# awaited.
+AWAITS_AITER = PY_VERSION < (3, 7)
+
+# Compile flags of sources run by run_code_async, letting them await at
+# top level where the host compiler allows it.
+TOP_LEVEL_AWAIT_FLAGS = getattr(ast, 'PyCF_ALLOW_TOP_LEVEL_AWAIT', 0)
+
+# Free frames kept per code object; deeper recursion allocates the rest.
+MAX_POOLED_FRAMES = 16
+
+# Marks an unbound fast local slot.
+NULL = object()
+
+
+def contains(first, second):
+    return first in second
+
+
+def not_contains(first, second):
+    return first not in second
+
+
+def exception_match(exception, target):
+    if not isinstance(exception, type):
+        exception = type(exception)
+    return issubclass(exception, target)
+
+
+# BINARY_OP (3.11) arguments are replaced by these callables at decode
+# time, keyed by the operator symbol dis reports as argrepr.
+BINARY_OPERATORS = {
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': operator.truediv,
+    '//': operator.floordiv,
+    '%': operator.mod,
+    '**': operator.pow,
+    '@': operator.matmul,
+    '<<': operator.lshift,
+    '>>': operator.rshift,
+    '&': operator.and_,
+    '|': operator.or_,
+    '^': operator.xor,
+    '+=': operator.iadd,
+    '-=': operator.isub,
+    '*=': operator.imul,
+    '/=': operator.itruediv,
+    '//=': operator.ifloordiv,
+    '%=': operator.imod,
+    '**=': operator.ipow,
+    '@=': operator.imatmul,
+    '<<=': operator.ilshift,
+    '>>=': operator.irshift,
+    '&=': operator.iand,
+    '|=': operator.ior,
+    '^=': operator.ixor,
+}
+
+# 3.6 arithmetic opcodes and the BINARY_OPERATORS symbol each applies.
+# Their handlers use the operator syntax directly; decode() still
+# resolves the callable into argval for superinstructions to use.
+BINARY_OPCODE_SYMBOLS = {
+    'BINARY_ADD': '+',
+    'BINARY_SUBTRACT': '-',
+    'BINARY_MULTIPLY': '*',
+    'BINARY_TRUE_DIVIDE': '/',
+    'BINARY_FLOOR_DIVIDE': '//',
+    'BINARY_MODULO': '%',
+    'BINARY_POWER': '**',
+    'BINARY_MATRIX_MULTIPLY': '@',
+    'BINARY_LSHIFT': '<<',
+    'BINARY_RSHIFT': '>>',
+    'BINARY_AND': '&',
+    'BINARY_OR': '|',
+    'BINARY_XOR': '^',
+    'INPLACE_ADD': '+=',
+    'INPLACE_SUBTRACT': '-=',
+    'INPLACE_MULTIPLY': '*=',
+    'INPLACE_TRUE_DIVIDE': '/=',
+    'INPLACE_FLOOR_DIVIDE': '//=',
+    'INPLACE_MODULO': '%=',
+    'INPLACE_POWER': '**=',
+    'INPLACE_MATRIX_MULTIPLY': '@=',
+    'INPLACE_LSHIFT': '<<=',
+    'INPLACE_RSHIFT': '>>=',
+    'INPLACE_AND': '&=',
+    'INPLACE_OR': '|=',
+    'INPLACE_XOR': '^=',
+}
+
+# COMPARE_OP arguments are replaced by these callables at decode time.
+COMPARE_OPERATORS = {
+    '<': operator.lt,
+    '<=': operator.le,
+    '==': operator.eq,
+    '!=': operator.ne,
+    '>': operator.gt,
+    '>=': operator.ge,
+    'in': contains,
+    'not in': not_contains,
+    'is': operator.is_,
+    'is not': operator.is_not,
+    'exception match': exception_match,
+}
+
+# Operator callables by symbol, for argvals of stored instruction streams.
+OPERATORS_BY_SYMBOL = dict(BINARY_OPERATORS, **COMPARE_OPERATORS)
+OPERATOR_SYMBOLS = {function: symbol
+                    for symbol, function in OPERATORS_BY_SYMBOL.items()}
+
+
+# Instruction sequences (by handler name) that decode() fuses into one
+# dispatch of the named handler. Tails of a fused sequence stay in the
+# instruction set but are skipped; a sequence is only fused when none of
+# its tail instructions is a jump target.
+SUPERINSTRUCTIONS = {
+    ('LOAD_FAST', 'LOAD_FAST'): 'LOAD_FAST__LOAD_FAST',
+    ('LOAD_FAST', 'LOAD_CONST'): 'LOAD_FAST__LOAD_CONST',
+    ('LOAD_FAST', 'LOAD_ATTR'): 'LOAD_FAST__LOAD_ATTR',
+    ('STORE_FAST', 'LOAD_FAST'): 'STORE_FAST__LOAD_FAST',
+    ('STORE_FAST', 'STORE_FAST'): 'STORE_FAST__STORE_FAST',
+    ('COMPARE_OP', 'POP_JUMP_IF_FALSE'): 'COMPARE_OP__POP_JUMP_IF_FALSE',
+    ('COMPARE_OP', 'POP_JUMP_IF_TRUE'): 'COMPARE_OP__POP_JUMP_IF_TRUE',
+    ('FOR_ITER', 'STORE_FAST'): 'FOR_ITER__STORE_FAST',
+    ('FOR_ITER', 'STORE_NAME'): 'FOR_ITER__STORE_NAME',
+    ('LOAD_FAST', 'LOAD_FAST', 'COMPARE_OP', 'POP_JUMP_IF_FALSE'):
+        'LOAD_FAST__LOAD_FAST__COMPARE_OP__POP_JUMP_IF_FALSE',
+}
+for binary_op in ['BINARY_OP'] + list(BINARY_OPCODE_SYMBOLS):
+    SUPERINSTRUCTIONS[('LOAD_FAST', 'LOAD_CONST', binary_op)] = \
+        'LOAD_FAST__LOAD_CONST__BINARY_OP'
+    SUPERINSTRUCTIONS[('LOAD_FAST', 'LOAD_CONST', binary_op, 'STORE_FAST')] = \
+        'LOAD_FAST__LOAD_CONST__BINARY_OP__STORE_FAST'
+
+
+# Generic handlers whose sites start out adaptive: they specialise in
+# place to the callee kind seen at run time and fall back on a guard miss.
+# Arithmetic, comparison and attribute sites stay generic: specialising
+# them on types measured roughly even overall and slower on numeric
+# loops (benchmarks/type_specialization.py).
+ADAPTIVE_HANDLERS = {
+    'CALL_FUNCTION': 'CALL_FUNCTION_ADAPTIVE',
+    'CALL': 'CALL_ADAPTIVE',
+    'LOAD_NAME': 'LOAD_NAME_ADAPTIVE',
+    'LOAD_GLOBAL': 'LOAD_GLOBAL_ADAPTIVE',
+}
+
+# Executions a de-specialised site waits before specialising again.
+QUICKEN_BACKOFF = 64
+
+# Compiled sources kept in memory by VirtualMachine.compile_source().
+COMPILE_CACHE_SIZE = 64
+
+# Identifies the handlers named by instruction streams in the on-disk code
+# cache; any change to this file invalidates cached entries.
+with open(__file__, 'rb') as vm_source:
+    VM_VERSION = hashlib.sha256(vm_source.read()).hexdigest()[:16]
+
+# Callables run natively; calls to them need no VM frame.
+NATIVE_CALLABLE_TYPES = frozenset([types.BuiltinFunctionType,
+                                   types.FunctionType,
+                                   types.MethodType,
+                                   type])
+
+
+def select_superinstructions(pair_counts, limit=None, min_count=1):
+    """Pick the SUPERINSTRUCTIONS worth emitting for a recorded profile.
+
+    pair_counts maps (handler name, handler name) pairs of consecutively
+    executed instructions to counts, as collected by
+    VirtualMachine.record_pairs(). A sequence scores the count of its
+    rarest adjacent pair; sequences scoring at least min_count are
+    returned, most frequent first, up to limit of them.
+    """
+    scored = []
+    for sequence in SUPERINSTRUCTIONS:
+        score = min(pair_counts.get(pair, 0)
+                    for pair in zip(sequence, sequence[1:]))
+        if score >= min_count:
+            scored.append((score, sequence))
+    scored.sort(reverse=True)
+    return [sequence for score, sequence in scored[:limit]]
+
+
+def nested_code_objects(code):
+    """code and the code objects in its constants, recursively, in a
+    deterministic order."""
+    codes = [code]
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            codes.extend(nested_code_objects(const))
+    return codes
+
+
+def load_pyc(path, source_path=None):
+    """The code object in a .pyc file written by this interpreter.
+
+    The header is checked the way the import system checks it: magic
+    number, then (from 3.7) the flags word, then, when the source can
+    be found, its mtime and size or its hash. source_path defaults to
+    the source importlib.util.source_from_cache() names for a
+    __pycache__ file, or the .py beside a legacy .pyc; without a source
+    the code is trusted as is. Raises ImportError for a bad or stale
+    file.
+    """
+    with open(path, 'rb') as pyc:
+        data = pyc.read()
+    if data[:4] != importlib.util.MAGIC_NUMBER:
+        raise ImportError('bad magic number in {!r}'.format(path))
+    if PY_VERSION >= (3, 7):
+        header_size = 16
+        flags = int.from_bytes(data[4:8], 'little')
+        if flags & ~0b11:
+            raise ImportError('invalid flags {!r} in {!r}'.format(flags,
+                                                                   path))
+    else:
+        header_size = 12
+        flags = 0
+    if len(data) < header_size:
+        raise ImportError('truncated header in {!r}'.format(path))
+
+    if source_path is None:
+        source_path = find_pyc_source(path)
+    if source_path is not None and os.path.exists(source_path):
+        if flags & 0b01:
+            # Hash-based; the source is only read when flagged as checked.
+            if flags & 0b10:
+                with open(source_path, 'rb') as source:
+                    source_hash = importlib.util.source_hash(source.read())
+                if data[8:16] != source_hash:
+                    raise ImportError('stale hash in {!r}'.format(path))
+        else:
+            stat = os.stat(source_path)
+            expected = ((int(stat.st_mtime) & 0xFFFFFFFF).to_bytes(4, 'little')
+                        + (stat.st_size & 0xFFFFFFFF).to_bytes(4, 'little'))
+            if data[header_size - 8:header_size] != expected:
+                raise ImportError('stale mtime or size in {!r}'.format(path))
+
+    code = marshal.loads(data[header_size:])
+    if not isinstance(code, types.CodeType):
+        raise ImportError('no code object in {!r}'.format(path))
+    return code
+
+
+def find_pyc_source(path):
+    try:
+        return importlib.util.source_from_cache(path)
+    except ValueError:
+        pass
+    if path.endswith('.pyc'):
+        return path[:-1]
+    return None
+
 
 class Frame(object):
-    def __init__(self, code, locals, globals, prev_frame):
-        self.code = code
-        self.ip = 0
+    __slots__ = ['code', 'ip', 'stack', 'block_stack', 'locals',
+                 'fast_locals', 'globals', 'prev_frame', 'builtins', 'cells',
+                 'instruction_set']
+
+    def __init__(self, code, locals, globals, prev_frame, fast_locals=None,
+                 closure=()):
         self.stack = []
         self.block_stack = []
+        self.cells = {}
+        self.instruction_set = None
+        self.reset(code, locals, globals, prev_frame, fast_locals, closure)
+
+    def reset(self, code, locals, globals, prev_frame, fast_locals=None,
+              closure=()):
+        self.code = code
+        self.ip = 0
+        # Function frames keep their variables in fast_locals, a list
+        # indexed like co_varnames; locals is then None and get_locals()
+        # builds a dict on demand. Module-level code uses locals directly.
         self.locals = locals
+        self.fast_locals = fast_locals
         self.globals = globals
         self.prev_frame = prev_frame
         if prev_frame:
@@ -22,47 +355,85 @@ class Frame(object):
         else:
             self.builtins = builtins.__dict__
 
-        self.cells = {}
         if self.code.co_cellvars:
             for var_name in self.code.co_cellvars:
-                if var_name in self.locals:
+                cell = Cell(None)
+                if self.fast_locals is not None:
+                    if var_name in self.code.co_varnames:
+                        index = self.code.co_varnames.index(var_name)
+                        cell = Cell(self.fast_locals[index])
+                elif var_name in self.locals:
                     cell = Cell(self.locals[var_name])
-                else:
-                    cell = Cell(None)
                 self.cells[var_name] = cell
-                if self.prev_frame:
-                    self.prev_frame.cells[var_name] = cell
-
-        if self.code.co_freevars and self.prev_frame:
-            for var_name in self.code.co_freevars:
-                self.cells[var_name] = self.prev_frame.cells[var_name]
-
-        self.operators = {
-            '==': operator.eq,
-            '>=': operator.ge,
-            '>': operator.gt,
-            'is': operator.is_,
-            'is not': operator.is_not,
-            '<=': operator.le,
-            '<': operator.lt,
-            '!=': operator.ne,
-            'not': operator.not_,
-            'in': lambda a, b: operator.contains(b, a)
-        }
 
-    def init_instruction_set(self, instructions):
-        self.instruction_set = []
-        for instr in instructions:
-            self.instruction_set += \
-                [None] * (instr.offset - len(self.instruction_set)) + [instr]
+        if self.code.co_freevars:
+            for var_name, cell in zip(self.code.co_freevars, closure):
+                self.cells[var_name] = cell
+
+    def clear(self):
+        """Drop references so the frame can wait in a free list.
+
+        The decoded instruction_set is kept: a pooled frame is only ever
+        reused for the code object it last ran.
+        """
+        self.code = None
+        self.locals = None
+        self.fast_locals = None
+        self.globals = None
+        self.prev_frame = None
+        self.builtins = None
+        if self.stack:
+            del self.stack[:]
+        if self.block_stack:
+            del self.block_stack[:]
+        if self.cells:
+            self.cells.clear()
+
+    def get_locals(self):
+        if self.fast_locals is None:
+            return self.locals
+        return {name: value
+                for (name, value) in zip(self.code.co_varnames,
+                                         self.fast_locals)
+                if value is not NULL}
 
     def dump(self, assignment='Frame dump'):
         print('{}:\n\tlocals={}\n\tglobals={}\n\tcells={}'
-              .format(assignment, self.locals, self.globals, self.cells))
+              .format(assignment, self.get_locals(), self.globals,
+                      self.cells))
+
+
+class Instruction(object):
+    """Decoded instruction. Jump arguments hold dense instruction indices."""
+    __slots__ = ['opname', 'opcode', 'arg', 'argval', 'offset', 'handler',
+                 'next_instr', 'counter', 'cache_version', 'cache_namespace']
+
+    def __init__(self, opname, opcode, arg, argval, offset, handler):
+        self.opname = opname
+        self.opcode = opcode
+        self.arg = arg
+        self.argval = argval
+        self.offset = offset
+        self.handler = handler
+        self.next_instr = None
+        # Executions an adaptive instruction waits before specialising.
+        self.counter = 0
+        # VirtualMachine.namespace_version and globals dict a cached name
+        # lookup is valid for. Frames with other globals may run the same
+        # instructions, e.g. when the same code runs twice.
+        self.cache_version = -1
+        self.cache_namespace = None
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.opname, self.argval)
 
 
 class Function(object):
-    __slots__ = ['__name__', '__annotations__', '__dict__', '__doc__']
+    __slots__ = ['__name__', '__annotations__', '__dict__', '__doc__',
+                 'code', 'vm', 'globals', 'pos_defaults', 'kw_defaults',
+                 'closure', 'fast_arg_count', 'locals_padding',
+                 'named_count', 'first_default', 'keyword_slots',
+                 'generator_type', '_func_obj']
 
     def __init__(self, name, code, vm, pos_defaults, kw_defaults,
                  annotations, closure):
@@ -71,42 +442,388 @@ class Function(object):
         self.__dict__ = {}
         self.__doc__ = code.co_consts[0] if code.co_consts else None
 
-        self.code = code
         self.vm = vm
+        self.globals = vm.frame.globals
         self.pos_defaults = pos_defaults
         self.kw_defaults = kw_defaults
         self.closure = closure
+        self.__code__ = code
+
+    @property
+    def __code__(self):
+        return self.code
 
-        func_obj_closure = tuple(
-            self.make_cell(0) for _ in self.closure
-        )
-        self.func_obj = types.FunctionType(code,
-                                           vm.frame.globals,
-                                           closure=func_obj_closure)
-        self.func_obj.__name__ = self.__name__
-        self.func_obj.__defaults__ = pos_defaults
-        self.func_obj.__kwdefaults__ = kw_defaults
-        self.func_obj.__annotations__ = annotations
-        self.func_obj.__dict__ = {}
+    @__code__.setter
+    def __code__(self, code):
+        self.code = code
+        # Calls passing exactly co_argcount positional arguments to a
+        # function without *args, **kwargs or keyword-only arguments
+        # bind by copying args; fast_arg_count is -1 when that can't apply.
+        # Calls to generator, coroutine and async generator functions,
+        # which only create the generator_type object, always bind the
+        # slow way.
+        flags = code.co_flags
+        self.generator_type = generator_type(flags)
+        if (flags & (inspect.CO_VARARGS | inspect.CO_VARKEYWORDS) or
+                code.co_kwonlyargcount or self.generator_type is not None):
+            self.fast_arg_count = -1
+        else:
+            self.fast_arg_count = code.co_argcount
+        self.locals_padding = (NULL,) * (code.co_nlocals - code.co_argcount)
+
+        # The binding plan of every other call: the slots after the
+        # positional and keyword-only parameters, the slot of the first
+        # positional default and, by name, the slot of each parameter
+        # that can be passed by keyword. Positional-only ones can't;
+        # their names go to **kwargs like any other unknown name.
+        self.named_count = code.co_argcount + code.co_kwonlyargcount
+        self.first_default = code.co_argcount - len(self.pos_defaults)
+        posonly_count = getattr(code, 'co_posonlyargcount', 0)
+        self.keyword_slots = {
+            name: slot for slot, name in enumerate(code.co_varnames)
+            if posonly_count <= slot < self.named_count
+        }
+        self._func_obj = None
+
+    @property
+    def func_obj(self):
+        """Native function with the same code, built on first use.
+
+        Only needed for introspection and for builtins.__build_class__,
+        which must run class bodies itself.
+        """
+        if self._func_obj is None:
+            func_obj_closure = tuple(
+                self.make_cell(cell.get()) for cell in self.closure
+            )
+            func_obj = types.FunctionType(self.code,
+                                          self.globals,
+                                          closure=func_obj_closure)
+            func_obj.__name__ = self.__name__
+            func_obj.__defaults__ = self.pos_defaults
+            func_obj.__kwdefaults__ = self.kw_defaults
+            func_obj.__annotations__ = self.__annotations__
+            func_obj.__dict__ = {}
+            self._func_obj = func_obj
+        return self._func_obj
 
     def __call__(self, *args, **kwargs):
-        args_to_frame = inspect.getcallargs(self.func_obj, *args, **kwargs)
-        for key in args_to_frame:
-            list_comp_magic_word = 'implicit'
-            if key.startswith(list_comp_magic_word):
-                new_key = key.replace(list_comp_magic_word, '.')
-                args_to_frame[new_key] = args_to_frame[key]
-                del args_to_frame[key]
-
-        func_frame = self.vm.make_frame(self.code, args_to_frame)
-        func_return = self.vm.run_frame(func_frame)
+        if not kwargs and len(args) == self.fast_arg_count:
+            fast_locals = list(args + self.locals_padding)
+        else:
+            fast_locals = self.bind_arguments(args, kwargs)
+
+        return self.run(fast_locals)
+
+    def run(self, fast_locals):
+        # Native code may call in from any thread; each runs guest code
+        # in its own execution context.
+        vm = self.vm
+        if vm.thread_id != threading.get_ident():
+            vm = vm.context()
+        func_frame = vm.make_frame(self.code, fast_locals,
+                                   globals=self.globals,
+                                   closure=self.closure)
+        if self.generator_type is not None:
+            return self.generator_type(vm, func_frame)
+        func_return = vm.run_frame(func_frame)
         return func_return
 
+    def bind_arguments(self, args, kwargs):
+        code = self.code
+        argcount = code.co_argcount
+        named_count = self.named_count
+        fast_locals = [NULL] * code.co_nlocals
+
+        num_positional = min(len(args), argcount)
+        fast_locals[:num_positional] = args[:num_positional]
+        extra_slot = named_count
+        if code.co_flags & inspect.CO_VARARGS:
+            fast_locals[extra_slot] = tuple(args[argcount:])
+            extra_slot += 1
+        elif len(args) > argcount:
+            raise TypeError(
+                '{}() takes {} positional arguments but {} were given'
+                .format(self.__name__, argcount, len(args)))
+
+        extra_kwargs = None
+        if code.co_flags & inspect.CO_VARKEYWORDS:
+            extra_kwargs = fast_locals[extra_slot] = {}
+
+        keyword_slots = self.keyword_slots
+        for name, value in kwargs.items():
+            slot = keyword_slots.get(name)
+            if slot is None:
+                if extra_kwargs is None:
+                    if name in code.co_varnames[:named_count]:
+                        raise TypeError(
+                            '{}() got some positional-only arguments passed '
+                            "as keyword arguments: '{}'"
+                            .format(self.__name__, name))
+                    raise TypeError(
+                        "{}() got an unexpected keyword argument '{}'"
+                        .format(self.__name__, name))
+                extra_kwargs[name] = value
+                continue
+            if fast_locals[slot] is not NULL:
+                raise TypeError(
+                    "{}() got multiple values for argument '{}'"
+                    .format(self.__name__, name))
+            fast_locals[slot] = value
+
+        first_default = self.first_default
+        missing = []
+        for slot in range(num_positional, named_count):
+            if fast_locals[slot] is not NULL:
+                continue
+            name = code.co_varnames[slot]
+            if first_default <= slot < argcount:
+                fast_locals[slot] = self.pos_defaults[slot - first_default]
+            elif slot >= argcount and name in self.kw_defaults:
+                fast_locals[slot] = self.kw_defaults[name]
+            else:
+                missing.append(name)
+        if missing:
+            raise TypeError('{}() missing required arguments: {}'
+                            .format(self.__name__, ', '.join(missing)))
+        return fast_locals
+
     def make_cell(self, value):
         fn = (lambda x: lambda: x)(value)
         return fn.__closure__[0]
 
 
+class Generator(object):
+    """A guest generator: a suspended frame, resumed by send().
+
+    Its frame only ever runs as the entry frame of VirtualMachine.run_frame,
+    which returns on YIELD_VALUE and on RETURN_VALUE alike; the VM notes
+    the frame that yielded last to tell the two apart.
+    """
+    __slots__ = ['__name__', 'vm', 'frame', 'running']
+
+    kind = 'generator'
+
+    def __init__(self, vm, frame):
+        self.__name__ = frame.code.co_name
+        self.vm = vm
+        self.frame = frame
+        self.running = False
+
+    def __repr__(self):
+        return '<{} object {} at {:#x}>'.format(self.kind, self.__name__,
+                                                id(self))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.send(None)
+
+    def send(self, value):
+        frame = self.frame
+        if frame is None:
+            raise StopIteration
+        if self.running:
+            raise ValueError('generator already executing')
+        if frame.ip:
+            # The value of the suspended yield expression.
+            frame.stack.append(value)
+        elif value is not None:
+            raise TypeError("can't send non-None value to a just-started "
+                            "generator")
+        return self.resume()
+
+    def resume(self):
+        frame = self.frame
+        vm = self.vm
+        if vm.thread_id != threading.get_ident():
+            # The frame moves to this thread's execution context, with
+            # instructions decoded for it; decoding is deterministic, so
+            # frame.ip stays valid.
+            vm = self.vm = vm.context()
+            frame.instruction_set = vm.get_instructions(frame.code)
+        self.running = True
+        try:
+            result = vm.run_frame(frame)
+        except StopIteration as stop:
+            self.frame = None
+            if PY_VERSION < (3, 7):
+                raise
+            raise RuntimeError('{} raised StopIteration'.format(self.kind)) \
+                from stop
+        except BaseException:
+            self.frame = None
+            raise
+        finally:
+            self.running = False
+        if vm.yielded_frame is frame:
+            vm.yielded_frame = None
+            return result
+        self.frame = None
+        raise StopIteration(result)
+
+    def throw(self, exc_type, value=None, traceback=None):
+        if isinstance(exc_type, BaseException):
+            exc = exc_type
+        elif isinstance(value, BaseException):
+            exc = value
+        elif value is None:
+            exc = exc_type()
+        else:
+            exc = exc_type(value)
+        if traceback is not None:
+            exc = exc.with_traceback(traceback)
+
+        frame = self.frame
+        send_index = self.vm.yield_from_index(frame) if frame else None
+        if send_index is not None:
+            delegate_throw = getattr(frame.stack[-1], 'throw', None)
+            if delegate_throw is not None:
+                self.running = True
+                try:
+                    return delegate_throw(exc)
+                except StopIteration as stop:
+                    self.vm.finish_yield_from(frame, send_index, stop.value)
+                    return self.resume()
+                except BaseException:
+                    self.frame = None
+                    raise
+                finally:
+                    self.running = False
+        # Guest code cannot handle exceptions, so it ends the generator.
+        self.frame = None
+        raise exc
+
+    def close(self):
+        if self.frame is None:
+            return
+        try:
+            self.throw(GeneratorExit)
+        except (GeneratorExit, StopIteration):
+            pass
+        else:
+            raise RuntimeError('{} ignored GeneratorExit'.format(self.kind))
+
+
+class Coroutine(Generator):
+    """A guest coroutine. Awaiting it drives it as a generator, so the
+    futures its awaits yield reach whatever runs it, e.g. an asyncio
+    Task."""
+    __slots__ = []
+    kind = 'coroutine'
+
+    def __await__(self):
+        return self
+
+
+# Lets asyncio accept guest coroutines wherever it takes coroutines.
+collections.abc.Coroutine.register(Coroutine)
+
+
+class AsyncGenValue(object):
+    """A value yielded by an async generator, as opposed to one its
+    awaits pass up."""
+    __slots__ = ['value']
+
+    def __init__(self, value):
+        self.value = value
+
+
+class AsyncGenerator(Generator):
+    """A guest async generator. Each step is awaited: it runs the frame
+    to its next yield, passing up what awaits in between yield."""
+    __slots__ = []
+    kind = 'async_generator'
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        return AsyncGeneratorStep(self, Generator.send, (None,))
+
+    def asend(self, value):
+        return AsyncGeneratorStep(self, Generator.send, (value,))
+
+    def athrow(self, exc_type, value=None, traceback=None):
+        return AsyncGeneratorStep(self, Generator.throw,
+                                  (exc_type, value, traceback))
+
+    def aclose(self):
+        return AsyncGeneratorStep(self, Generator.throw, (GeneratorExit,),
+                                  closing=True)
+
+    def step(self, method, args, closing=False):
+        try:
+            result = method(self, *args)
+        except (StopIteration, GeneratorExit) as exc:
+            if closing:
+                raise StopIteration
+            if isinstance(exc, GeneratorExit):
+                raise
+            raise StopAsyncIteration
+        if type(result) is AsyncGenValue:
+            if closing:
+                raise RuntimeError('async generator ignored GeneratorExit')
+            raise StopIteration(result.value)
+        return result
+
+
+class AsyncGeneratorStep(object):
+    """The awaitable returned by AsyncGenerator.__anext__, asend, athrow
+    and aclose: its first step calls method with args, later ones pass
+    what the awaiting code sends on to the generator."""
+    __slots__ = ['agen', 'method', 'args', 'closing', 'started']
+
+    def __init__(self, agen, method, args, closing=False):
+        self.agen = agen
+        self.method = method
+        self.args = args
+        self.closing = closing
+        self.started = False
+
+    def __await__(self):
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.send(None)
+
+    def send(self, value):
+        if self.started:
+            return self.agen.step(Generator.send, (value,), self.closing)
+        self.started = True
+        return self.agen.step(self.method, self.args, self.closing)
+
+    def throw(self, exc_type, value=None, traceback=None):
+        self.started = True
+        return self.agen.step(Generator.throw, (exc_type, value, traceback),
+                              self.closing)
+
+    def close(self):
+        pass
+
+
+def generator_type(flags):
+    """The class a call to a function with code flags returns instead of
+    running it, or None."""
+    if flags & inspect.CO_GENERATOR:
+        return Generator
+    if flags & inspect.CO_COROUTINE:
+        return Coroutine
+    if flags & inspect.CO_ASYNC_GENERATOR:
+        return AsyncGenerator
+    return None
+
+
+def awaitable_result(value):
+    """An awaitable that completes with value at once."""
+    return value
+    yield
+
+
 class Cell(object):
     def __init__(self, value):
         self.value = value
@@ -119,9 +836,138 @@ class Cell(object):
 
 
 class VirtualMachine(object):
-    def __init__(self):
+    def __init__(self, superinstructions=None, cache_dir=None):
+        """superinstructions: the SUPERINSTRUCTIONS sequences to fuse
+        while decoding, e.g. from select_superinstructions(); all of
+        them by default, none if empty.
+
+        cache_dir: directory for compiled code and decoded instruction
+        streams of the sources run, reused across VMs and processes."""
         self.frame_stack = []
         self.frame = None
+        # Decoded instruction streams, shared by every frame of a code
+        # object. Weak keys let code objects be freed once unreachable.
+        self.decode_cache = weakref.WeakKeyDictionary()
+        self.decode_hits = 0
+        self.decode_misses = 0
+        # Finished frames waiting to be reused by the same code object.
+        self.frame_pool = weakref.WeakKeyDictionary()
+        # Opcode number -> bound handler, resolved once per decoded
+        # instruction rather than looked up by name on every dispatch.
+        self.dispatch_table = [
+            getattr(self, OPCODE_HANDLER_NAMES.get(opname, opname) or opname,
+                    self.unknown_opcode)
+            for opname in dis.opname
+        ]
+        self.adaptive_handlers = {
+            opcode: getattr(self, ADAPTIVE_HANDLERS[handler.__name__])
+            for opcode, handler in enumerate(self.dispatch_table)
+            if handler.__name__ in ADAPTIVE_HANDLERS
+        }
+        self.specializations = 0
+        self.specialization_hits = 0
+        self.specialization_misses = 0
+        # Changed whenever a name is added to or removed from a namespace,
+        # which is all that can move a name between locals, globals and
+        # builtins. Rebinding an existing name leaves it unchanged. The
+        # one-item list is shared with every execution context, as they
+        # share the namespaces; new values come from a shared counter, so
+        # racing bumps never bring back an earlier version.
+        self.namespace_version = [0]
+        self.namespace_versions = itertools.count(1)
+        if superinstructions is None:
+            superinstructions = SUPERINSTRUCTIONS
+        self.superinstructions = {
+            tuple(sequence): getattr(self, SUPERINSTRUCTIONS[sequence])
+            for sequence in superinstructions
+        }
+        self.superinstruction_lengths = sorted(
+            set(map(len, self.superinstructions)), reverse=True)
+        # Source digest -> code object, least recently used first.
+        self.compile_cache = collections.OrderedDict()
+        self.cache_dir = cache_dir
+        # Stored instruction streams name handlers, which depend on the
+        # superinstructions fused.
+        self.cache_config = repr(sorted(self.superinstructions))
+        # The profiling.Profile being collected, if profiling is on.
+        self.profile = None
+        # The generator frame that run_frame last returned from by
+        # yielding rather than returning.
+        self.yielded_frame = None
+        # A VM is the execution context of the thread that created it;
+        # context() gives other threads sibling VMs, sharing its
+        # configuration and compiled code.
+        self.root = self
+        self.thread_id = threading.get_ident()
+        self.thread_contexts = threading.local()
+        self.compile_lock = threading.Lock()
+
+    def context(self):
+        """The VM that runs guest code on the calling thread.
+
+        Frames, decoded instructions and their inline caches belong to
+        one thread, so each thread gets its own VM, created on first use
+        and sharing the compile cache with this one.
+        """
+        thread_id = threading.get_ident()
+        if thread_id == self.thread_id:
+            return self
+        root = self.root
+        if thread_id == root.thread_id:
+            return root
+        context = getattr(root.thread_contexts, 'vm', None)
+        if context is None:
+            context = root.thread_contexts.vm = root.spawn()
+        return context
+
+    def bump_namespace_version(self):
+        self.namespace_version[0] = next(self.namespace_versions)
+
+    def spawn(self):
+        """A new execution context for the calling thread."""
+        context = type(self)(superinstructions=tuple(self.superinstructions),
+                             cache_dir=self.cache_dir)
+        context.root = self.root
+        context.compile_cache = self.compile_cache
+        context.compile_lock = self.compile_lock
+        context.namespace_version = self.namespace_version
+        context.namespace_versions = self.namespace_versions
+        return context
+
+    def map_run(self, sources, workers=None, filename='<string>'):
+        """Run sources (source strings or code objects) on a pool of
+        workers threads, each in its own module namespace, and return the
+        namespaces in order. The first error raised is re-raised.
+
+        Threads share the GIL, so this isolates scripts from each other
+        rather than running them in parallel.
+        """
+        def run(source):
+            return self.context().run_code(source, filename)
+
+        with ThreadPoolExecutor(workers) as executor:
+            return list(executor.map(run, sources))
+
+    def enable_profiling(self):
+        """Collect a profiling.Profile of everything run from now on.
+
+        Profiled frames run in a separate dispatch loop, so profiling
+        costs nothing when off.
+        """
+        self.profile = profiling.Profile()
+        return self.profile
+
+    def disable_profiling(self):
+        profile, self.profile = self.profile, None
+        return profile
+
+    def record_pairs(self):
+        """Count consecutively executed handler pairs.
+
+        Record on a VM created with superinstructions=() so that every
+        instruction is dispatched on its own.
+        """
+        return self.enable_profiling().pair_counts
 
     def push_frame(self, frame):
         self.frame_stack.append(frame)
@@ -134,76 +980,450 @@ class VirtualMachine(object):
         else:
             self.frame = None
 
-    def run_code(self, code):
+    def run_code(self, code, filename='<test>'):
+        """Run code in a new module namespace and return the namespace."""
         if isinstance(code, str):
-            code = compile(code, '<test>', 'exec')
-        frame = self.make_frame(code, args={})
+            code = self.compile_source(code, filename)
+        frame = self.make_frame(code)
+        namespace = frame.globals
         self.run_frame(frame)
+        return namespace
+
+    async def run_code_async(self, code, filename='<test>'):
+        """Run code as a coroutine, e.g. a task of an asyncio event loop.
+
+        Sources may await at top level where the host compiler allows it
+        (Python 3.8+); their awaits let other tasks run meanwhile.
+        Each run gets its own module namespace.
+        """
+        if isinstance(code, str):
+            code = self.compile_source(code, filename, TOP_LEVEL_AWAIT_FLAGS)
+        frame = self.make_frame(code)
+        if code.co_flags & inspect.CO_COROUTINE:
+            return await Coroutine(self, frame)
+        return self.run_frame(frame)
+
+    def run_file(self, filename):
+        with open(filename) as source:
+            self.run_code(source.read(), filename)
+
+    def run_pyc(self, path, source_path=None):
+        self.run_code(load_pyc(path, source_path))
+
+    def compile_source(self, source, filename='<test>', flags=0):
+        """Compile source, reusing the code object of an earlier identical
+        source from memory or, with a cache_dir, from disk."""
+        digest = hashlib.sha256(
+            '{}\0{}\0{}'.format(filename, flags, source).encode(
+                'utf-8', 'surrogatepass')
+        ).hexdigest()
+        with self.compile_lock:
+            code = self.compile_cache.get(digest)
+            if code is not None:
+                self.compile_cache.move_to_end(digest)
+                return code
+        if self.cache_dir is not None:
+            code = self.load_cached_code(digest)
+        if code is None:
+            code = compile(source, filename, 'exec', flags)
+            if self.cache_dir is not None:
+                self.store_cached_code(digest, code)
+        with self.compile_lock:
+            self.compile_cache[digest] = code
+            if len(self.compile_cache) > COMPILE_CACHE_SIZE:
+                self.compile_cache.popitem(last=False)
+        return code
+
+    def cache_path(self, digest):
+        # Named per interpreter: marshal cannot even load another
+        # version's code objects to check the header.
+        return os.path.join(self.cache_dir, '{}.{}.vmc'.format(
+            digest, sys.implementation.cache_tag))
+
+    def cache_header(self):
+        return (importlib.util.MAGIC_NUMBER, VM_VERSION, self.cache_config)
+
+    def load_cached_code(self, digest):
+        try:
+            with open(self.cache_path(digest), 'rb') as cached:
+                header, code, streams = marshal.load(cached)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        if header != self.cache_header():
+            return None
+        for nested_code, stream in zip(nested_code_objects(code), streams):
+            self.decode_cache[nested_code] = self.load_instructions(stream)
+        return code
+
+    def store_cached_code(self, digest, code):
+        streams = tuple(self.store_instructions(self.get_instructions(nested))
+                        for nested in nested_code_objects(code))
+        try:
+            data = marshal.dumps((self.cache_header(), code, streams))
+        except ValueError:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.cache_path(digest)
+        # Written aside and renamed so that readers never see a partial
+        # entry.
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'wb') as cached:
+            cached.write(data)
+        os.replace(temp_path, path)
+
+    @staticmethod
+    def store_instructions(instruction_set):
+        """A marshallable form of a freshly decoded instruction set:
+        handlers by name and operator argvals by symbol."""
+        stored = []
+        for instr in instruction_set:
+            argval = instr.argval
+            symbol = None
+            if callable(argval):
+                symbol = OPERATOR_SYMBOLS.get(argval)
+            stored.append((instr.opname, instr.opcode, instr.arg,
+                           argval if symbol is None else None, symbol,
+                           instr.offset, instr.handler.__name__))
+        return tuple(stored)
+
+    def load_instructions(self, stored):
+        instruction_set = []
+        for (opname, opcode, arg, argval, symbol, offset,
+             handler_name) in stored:
+            if symbol is not None:
+                argval = OPERATORS_BY_SYMBOL[symbol]
+            instruction_set.append(Instruction(
+                opname=opname, opcode=opcode, arg=arg, argval=argval,
+                offset=offset, handler=getattr(self, handler_name)))
+        for instr, next_instr in zip(instruction_set, instruction_set[1:]):
+            instr.next_instr = next_instr
+        return tuple(instruction_set)
+
+    def get_instructions(self, code):
+        try:
+            instruction_set = self.decode_cache[code]
+        except KeyError:
+            self.decode_misses += 1
+            instruction_set = self.decode(code)
+            self.decode_cache[code] = instruction_set
+        else:
+            self.decode_hits += 1
+        return instruction_set
+
+    def decode(self, code):
+        instruction_set = []
+        offset_to_index = {}
+        kw_names = ()
+        for instr in dis.get_instructions(code):
+            offset_to_index[instr.offset] = len(instruction_set)
+            if instr.opname == 'KW_NAMES':
+                kw_names = code.co_consts[instr.arg]
+            if instr.opcode in SKIPPED_OPCODES:
+                continue
+
+            argval = instr.argval
+            if instr.opname == 'COMPARE_OP':
+                argval = COMPARE_OPERATORS[argval]
+            elif instr.opname == 'IS_OP':
+                argval = COMPARE_OPERATORS['is not' if instr.arg else 'is']
+            elif instr.opname == 'CONTAINS_OP':
+                argval = COMPARE_OPERATORS['not in' if instr.arg else 'in']
+            elif instr.opname == 'BINARY_OP':
+                argval = BINARY_OPERATORS[instr.argrepr]
+            elif instr.opname in BINARY_OPCODE_SYMBOLS:
+                argval = BINARY_OPERATORS[BINARY_OPCODE_SYMBOLS[instr.opname]]
+            elif instr.opname == 'CALL':
+                argval, kw_names = kw_names, ()
+            elif instr.opname == 'FORMAT_VALUE':
+                # The handler reads the flags from arg.
+                argval = instr.arg
+            elif (instr.opname == 'LOAD_GLOBAL' and
+                    LOAD_GLOBAL_PUSHES_NULL and instr.arg & 1):
+                push_null = dis.opmap['PUSH_NULL']
+                instruction_set.append(Instruction(
+                    opname='PUSH_NULL', opcode=push_null, arg=None,
+                    argval=None, offset=instr.offset,
+                    handler=self.dispatch_table[push_null]))
+            handler = self.dispatch_table[instr.opcode]
+            if (instr.opname == 'YIELD_VALUE' and ASYNC_GEN_WRAPS_YIELDS and
+                    code.co_flags & inspect.CO_ASYNC_GENERATOR):
+                handler = self.YIELD_VALUE_ASYNC_GEN
+            instruction_set.append(Instruction(opname=instr.opname,
+                                               opcode=instr.opcode,
+                                               arg=instr.arg,
+                                               argval=argval,
+                                               offset=instr.offset,
+                                               handler=handler))
+        offset_to_index[len(code.co_code)] = len(instruction_set)
+
+        # Jumps to dropped instructions land on the next kept one.
+        jump_targets = set()
+        for instr in instruction_set:
+            if instr.opcode in JUMP_OPCODES:
+                instr.argval = offset_to_index[instr.argval]
+                jump_targets.add(instr.argval)
+        for instr, next_instr in zip(instruction_set, instruction_set[1:]):
+            instr.next_instr = next_instr
+        self.fuse_superinstructions(instruction_set, jump_targets)
+        for instr in instruction_set:
+            adaptive = self.adaptive_handlers.get(instr.opcode)
+            if (adaptive is not None and
+                    instr.handler is self.dispatch_table[instr.opcode]):
+                instr.handler = adaptive
+        return tuple(instruction_set)
+
+    def fuse_superinstructions(self, instruction_set, jump_targets):
+        index = 0
+        while index < len(instruction_set):
+            step = 1
+            for length in self.superinstruction_lengths:
+                sequence = instruction_set[index:index + length]
+                names = tuple(instr.handler.__name__ for instr in sequence)
+                handler = self.superinstructions.get(names)
+                if handler is None:
+                    continue
+                if jump_targets.intersection(range(index + 1,
+                                                   index + length)):
+                    continue
+                instruction_set[index].handler = handler
+                step = length
+                break
+            index += step
 
-    def make_frame(self, code, args):
-        if not self.frame:
-            locals = globals = {
+    def make_frame(self, code, fast_locals=None, globals=None, closure=()):
+        if globals is None:
+            globals = {
                 '__builtins__': __builtins__,
                 '__name__': '__main__',
                 '__doc__': None,
                 '__package__': None
             }
-            new_frame = Frame(code=code,
-                              locals=locals,
-                              globals=globals,
-                              prev_frame=None)
+            self.bump_namespace_version()
+        locals = globals if fast_locals is None else None
+        free_frames = self.frame_pool.get(code)
+        if free_frames:
+            new_frame = free_frames.pop()
+            new_frame.reset(code, locals, globals, self.frame, fast_locals,
+                            closure)
             return new_frame
-
-        new_globals = self.frame.globals
-        new_globals.update(self.frame.locals)
-        new_frame = Frame(code=code, locals=args, globals=new_globals,
-                          prev_frame=self.frame)
+        new_frame = Frame(code=code,
+                          locals=locals,
+                          globals=globals,
+                          prev_frame=self.frame,
+                          fast_locals=fast_locals,
+                          closure=closure)
         return new_frame
 
+    def release_frame(self, frame):
+        free_frames = self.frame_pool.get(frame.code)
+        if free_frames is None:
+            free_frames = self.frame_pool[frame.code] = []
+        if len(free_frames) < MAX_POOLED_FRAMES:
+            frame.clear()
+            free_frames.append(frame)
+
+    # Handlers report control transfers between frames by returning
+    # 'call' once they have pushed a guest frame and 'return' when the
+    # current frame's return value is on top of its stack. Guest calls
+    # thus run in the caller's dispatch loop; only calls made by native
+    # code re-enter run_frame. Generator frames, always run as entry
+    # frames, report 'yield' with the yielded value on top of the stack.
+
     def run_frame(self, frame):
+        """Run frame and the guest calls it makes until frame returns;
+        return its return value."""
+        if self.profile is not None:
+            return self.run_frame_profiling(frame)
+        entry_frame = frame
+        entry_depth = len(self.frame_stack)
+        self.push_frame(frame)
+        try:
+            while True:
+                frame = self.frame
+                if frame.instruction_set is None:
+                    frame.instruction_set = self.get_instructions(frame.code)
+                instruction_set = frame.instruction_set
+                report = None
+                while report is None:
+                    instr = instruction_set[frame.ip]
+                    frame.ip += 1
+                    report = instr.handler(instr)
+                if report == 'return':
+                    value = frame.stack.pop()
+                    self.pop_frame()
+                    self.release_frame(frame)
+                    if frame is entry_frame:
+                        return value
+                    self.frame.stack.append(value)
+                elif report == 'yield':
+                    self.yielded_frame = frame
+                    value = frame.stack.pop()
+                    self.pop_frame()
+                    return value
+        except BaseException:
+            self.unwind(entry_depth)
+            raise
+
+    def run_frame_profiling(self, frame):
+        profile = self.profile
+        clock = profile.clock
+        entry_frame = frame
+        entry_depth = len(self.frame_stack)
         self.push_frame(frame)
-        instructions = dis.get_instructions(self.frame.code)
-        self.frame.init_instruction_set(instructions)
+        # Per running frame: its profile entry and the handler that ran
+        # before the call it is waiting on.
+        entries = [profile.enter(frame.code)]
+        prev_names = []
 
-        while self.frame.ip < len(self.frame.instruction_set):
-            instr = self.frame.instruction_set[self.frame.ip]
-            if not instr:
-                self.frame.ip += 1
-                continue
-            opname = instr.opname
-            if opname.startswith('INPLACE'):
-                opname = opname.replace('INPLACE', 'BINARY')
-            method = getattr(self, opname)
-            # print('HELLO! {}: {}'.format(instr.opname, instr.argval))
-            method_report = method(instr)
-            if method_report == 'return':
-                break
-            self.frame.ip += 1
+        prev_name = None
+        try:
+            while True:
+                frame = self.frame
+                if frame.instruction_set is None:
+                    frame.instruction_set = self.get_instructions(frame.code)
+                instruction_set = frame.instruction_set
+                entry = entries[-1]
+                report = None
+                while report is None:
+                    instr = instruction_set[frame.ip]
+                    frame.ip += 1
+                    name = self.dispatch_table[instr.opcode].__name__
+                    if prev_name is not None:
+                        profile.pair_counts[prev_name, name] += 1
+                    prev_name = name
+                    handler_name = instr.handler.__name__
+                    callee_time = entry[2]
+                    start = clock()
+                    report = instr.handler(instr)
+                    elapsed = clock() - start - (entry[2] - callee_time)
+                    profile.opcode_counts[handler_name] += 1
+                    profile.opcode_times[handler_name] += elapsed
+                if report == 'call':
+                    entries.append(profile.enter(self.frame.code))
+                    prev_names.append(prev_name)
+                    prev_name = None
+                    continue
+                profile.exit(entries.pop())
+                value = frame.stack.pop()
+                self.pop_frame()
+                if report == 'yield':
+                    self.yielded_frame = frame
+                    return value
+                self.release_frame(frame)
+                if frame is entry_frame:
+                    return value
+                self.frame.stack.append(value)
+                prev_name = prev_names.pop()
+        except BaseException:
+            while entries:
+                profile.exit(entries.pop())
+            self.unwind(entry_depth)
+            raise
 
-        frame_return = self.frame_stack.pop()
-        self.pop_frame()
-        return frame_return
+    def yield_from_index(self, frame):
+        """Index of the YIELD_FROM (3.6) or SEND (3.11) a suspended
+        frame resumes at, if it is delegating to a sub-iterator."""
+        if not frame.ip or frame.instruction_set is None:
+            return None
+        instr = frame.instruction_set[frame.ip]
+        if instr.opname == 'YIELD_FROM':
+            return frame.ip
+        if (instr.opname == 'JUMP_BACKWARD_NO_INTERRUPT' and
+                frame.instruction_set[instr.argval].opname == 'SEND'):
+            return instr.argval
+        return None
+
+    def finish_yield_from(self, frame, send_index, value):
+        """Complete a suspended yield from with value as its result."""
+        frame.stack[-1] = value
+        send = frame.instruction_set[send_index]
+        if send.opname == 'SEND':
+            frame.ip = send.argval
+        else:
+            frame.ip = send_index + 1
+
+    def get_awaitable(self, value):
+        """The iterator an await on value delegates to."""
+        if (type(value) is Coroutine or inspect.isgenerator(value) and
+                value.gi_code.co_flags & inspect.CO_ITERABLE_COROUTINE):
+            return value
+        await_method = getattr(type(value), '__await__', None)
+        if await_method is None:
+            raise TypeError("object {} can't be used in 'await' expression"
+                            .format(type(value).__name__))
+        return await_method(value)
+
+    def end_async_for(self):
+        """Leave the async for loop whose __anext__ awaitable the current
+        instruction delegates to, now that it raised StopAsyncIteration.
+        Return False if the delegate is no __anext__ awaitable."""
+        frame = self.frame
+        instruction_set = frame.instruction_set
+        index = frame.ip - 1
+        if index < 2 or instruction_set[index - 2].opname != 'GET_ANEXT':
+            return False
+        # Drop the __anext__ awaitable, leaving the async iterator.
+        frame.stack.pop()
+        if frame.block_stack and 'handler' in frame.block_stack[-1]:
+            # Before 3.7: enter the loop's SETUP_EXCEPT handler as the
+            # exception would; it matches StopAsyncIteration and pops the
+            # loop.
+            handler = frame.block_stack.pop()['handler']
+            frame.stack.extend([None, StopAsyncIteration(),
+                                StopAsyncIteration])
+            frame.ip = handler
+            return True
+        # From 3.8: skip the END_ASYNC_FOR that ends this loop, which would
+        # have popped the async iterator.
+        nested = 0
+        for index in range(index + 1, len(instruction_set)):
+            opname = instruction_set[index].opname
+            if opname == 'GET_ANEXT':
+                nested += 1
+            elif opname == 'END_ASYNC_FOR':
+                if not nested:
+                    break
+                nested -= 1
+        frame.stack.pop()
+        frame.ip = index + 1
+        return True
+
+    def unwind(self, depth):
+        """Drop the frames above depth, left by an exception."""
+        del self.frame_stack[depth:]
+        self.frame = self.frame_stack[-1] if self.frame_stack else None
+
+    def unknown_opcode(self, instr):
+        raise AttributeError('unsupported opcode {}'.format(instr.opname))
+
+    def unbound_local(self, instr):
+        raise UnboundLocalError(
+            "local variable '{}' referenced before assignment"
+            .format(instr.argval))
 
     def STORE_NAME(self, instr):
+        if instr.argval not in self.frame.locals:
+            self.bump_namespace_version()
         self.frame.locals[instr.argval] = self.frame.stack.pop()
 
     def STORE_FAST(self, instr):
-        self.frame.locals[instr.argval] = self.frame.stack.pop()
+        self.frame.fast_locals[instr.arg] = self.frame.stack.pop()
 
     def STORE_GLOBAL(self, instr):
+        if instr.argval not in self.frame.globals:
+            self.bump_namespace_version()
         self.frame.globals[instr.argval] = self.frame.stack.pop()
 
     def STORE_SUBSCR(self, instr):
         third, second, first = self.frame.stack[-3:]
+        del self.frame.stack[-3:]
         second[first] = third
 
     def STORE_ATTR(self, instr):
         name = instr.argval
         first = self.frame.stack.pop()
         second = self.frame.stack.pop()
-        first.__dict__[name] = second
-        self.frame.stack.append(second)
-        self.frame.stack.append(first)
+        setattr(first, name, second)
 
     def STORE_DEREF(self, instr):
         name = instr.argval
@@ -212,6 +1432,7 @@ class VirtualMachine(object):
 
     def SETUP_ANNOTATIONS(self, instr):
         if '__annotations__' not in self.frame.locals:
+            self.bump_namespace_version()
             self.frame.locals['__annotations__'] = {}
 
     def STORE_ANNOTATION(self, instr):
@@ -230,23 +1451,116 @@ class VirtualMachine(object):
             self.frame.stack.append(self.frame.globals[name])
         elif name in self.frame.builtins:
             self.frame.stack.append(self.frame.builtins[name])
+        else:
+            raise NameError("name '{}' is not defined".format(name))
 
-    def LOAD_FAST(self, instr):
+    def LOAD_NAME_ADAPTIVE(self, instr):
         name = instr.argval
-        self.frame.stack.append(self.frame.locals[name])
+        if name in self.frame.locals:
+            instr.handler = self.LOAD_NAME_LOCALS
+        elif name in self.frame.globals:
+            instr.handler = self.LOAD_NAME_GLOBALS
+        elif name in self.frame.builtins:
+            instr.handler = self.LOAD_NAME_BUILTINS
+        else:
+            return self.LOAD_NAME(instr)
+        instr.cache_version = self.namespace_version[0]
+        instr.cache_namespace = self.frame.globals
+        instr.handler(instr)
+
+    # Cached lookups remember which namespace held the name, not its
+    # value, so they stay valid until a namespace gains or loses a name
+    # or the instruction runs against another globals dict. Native code,
+    # such as the methods of guest classes, changes the namespaces
+    # without bumping the version, so a cached name that has gone or a
+    # builtin that a global now shadows is resolved again.
+    def LOAD_NAME_LOCALS(self, instr):
+        frame = self.frame
+        if (instr.cache_version != self.namespace_version[0] or
+                instr.cache_namespace is not frame.globals):
+            return self.LOAD_NAME_ADAPTIVE(instr)
+        try:
+            frame.stack.append(frame.locals[instr.argval])
+        except KeyError:
+            return self.LOAD_NAME_ADAPTIVE(instr)
+
+    def LOAD_NAME_GLOBALS(self, instr):
+        frame = self.frame
+        if (instr.cache_version != self.namespace_version[0] or
+                instr.cache_namespace is not frame.globals):
+            return self.LOAD_NAME_ADAPTIVE(instr)
+        try:
+            frame.stack.append(frame.globals[instr.argval])
+        except KeyError:
+            return self.LOAD_NAME_ADAPTIVE(instr)
+
+    def LOAD_NAME_BUILTINS(self, instr):
+        frame = self.frame
+        if (instr.cache_version != self.namespace_version[0] or
+                instr.cache_namespace is not frame.globals or
+                instr.argval in frame.globals):
+            return self.LOAD_NAME_ADAPTIVE(instr)
+        frame.stack.append(frame.builtins[instr.argval])
+
+    def LOAD_FAST(self, instr):
+        value = self.frame.fast_locals[instr.arg]
+        if value is NULL:
+            self.unbound_local(instr)
+        self.frame.stack.append(value)
 
     def LOAD_GLOBAL(self, instr):
         name = instr.argval
         if name in self.frame.globals:
             self.frame.stack.append(self.frame.globals[name])
-        else:
+        elif name in self.frame.builtins:
             self.frame.stack.append(self.frame.builtins[name])
+        else:
+            raise NameError("name '{}' is not defined".format(name))
+
+    def LOAD_GLOBAL_ADAPTIVE(self, instr):
+        name = instr.argval
+        if name in self.frame.globals:
+            instr.handler = self.LOAD_GLOBAL_GLOBALS
+        elif name in self.frame.builtins:
+            instr.handler = self.LOAD_GLOBAL_BUILTINS
+        else:
+            return self.LOAD_GLOBAL(instr)
+        instr.cache_version = self.namespace_version[0]
+        instr.cache_namespace = self.frame.globals
+        instr.handler(instr)
+
+    def LOAD_GLOBAL_GLOBALS(self, instr):
+        frame = self.frame
+        if (instr.cache_version != self.namespace_version[0] or
+                instr.cache_namespace is not frame.globals):
+            return self.LOAD_GLOBAL_ADAPTIVE(instr)
+        try:
+            frame.stack.append(frame.globals[instr.argval])
+        except KeyError:
+            return self.LOAD_GLOBAL_ADAPTIVE(instr)
+
+    def LOAD_GLOBAL_BUILTINS(self, instr):
+        frame = self.frame
+        if (instr.cache_version != self.namespace_version[0] or
+                instr.cache_namespace is not frame.globals or
+                instr.argval in frame.globals):
+            return self.LOAD_GLOBAL_ADAPTIVE(instr)
+        frame.stack.append(frame.builtins[instr.argval])
 
     def LOAD_ATTR(self, instr):
         name = instr.argval
         tos = self.frame.stack.pop()
         self.frame.stack.append(getattr(tos, name))
 
+    def LOAD_METHOD(self, instr):
+        name = instr.argval
+        tos = self.frame.stack.pop()
+        self.frame.stack.append(NULL)
+        self.frame.stack.append(getattr(tos, name))
+
+    def LOAD_ASSERTION_ERROR(self, instr):
+        self.frame.stack.append(AssertionError)
+
     def LOAD_CLOSURE(self, instr):
         name = instr.argval
         self.frame.stack.append(self.frame.cells[name])
@@ -269,31 +1583,30 @@ class VirtualMachine(object):
     def DELETE_ATTR(self, instr):
         name = instr.argval
         tos = self.frame.stack.pop()
-        del tos.__dict__[name]
-        self.frame.stack.append(tos)
+        delattr(tos, name)
 
     def DELETE_FAST(self, instr):
-        name = instr.argval
-        del self.frame.locals[name]
+        if self.frame.fast_locals[instr.arg] is NULL:
+            self.unbound_local(instr)
+        self.frame.fast_locals[instr.arg] = NULL
 
     def DELETE_GLOBAL(self, instr):
         name = instr.argval
+        self.bump_namespace_version()
         del self.frame.globals[name]
 
     def DELETE_NAME(self, instr):
         name = instr.argval
+        self.bump_namespace_version()
         if name in self.frame.locals:
             del self.frame.locals[name]
         else:
             del self.frame.globals[name]
 
     def DELETE_SUBSCR(self, instr):
-        name = instr.argval
         first = self.frame.stack.pop()
         second = self.frame.stack.pop()
         del second[first]
-        self.frame.stack.append(second)
-        self.frame.stack.append(first)
 
     def DELETE_DEREF(self, instr):
         name = instr.argval
@@ -385,6 +1698,89 @@ class VirtualMachine(object):
         second = self.frame.stack.pop()
         self.frame.stack.append(second | first)
 
+    def INPLACE_POWER(self, instr):
+        first = self.frame.stack.pop()
+        second = self.frame.stack.pop()
+        second **= first
+        self.frame.stack.append(second)
+
+    def INPLACE_MULTIPLY(self, instr):
+        first = self.frame.stack.pop()
+        second = self.frame.stack.pop()
+        second *= first
+        self.frame.stack.append(second)
+
+    def INPLACE_MATRIX_MULTIPLY(self, instr):
+        first = self.frame.stack.pop()
+        second = self.frame.stack.pop()
+        second @= first
+        self.frame.stack.append(second)
+
+    def INPLACE_FLOOR_DIVIDE(self, instr):
+        first = self.frame.stack.pop()
+        second = self.frame.stack.pop()
+        second //= first
+        self.frame.stack.append(second)
+
+    def INPLACE_TRUE_DIVIDE(self, instr):
+        first = self.frame.stack.pop()
+        second = self.frame.stack.pop()
+        second /= first
+        self.frame.stack.append(second)
+
+    def INPLACE_MODULO(self, instr):
+        first = self.frame.stack.pop()
+        second = self.frame.stack.pop()
+        second %= first
+        self.frame.stack.append(second)
+
+    def INPLACE_ADD(self, instr):
+        first = self.frame.stack.pop()
+        second = self.frame.stack.pop()
+        second += first
+        self.frame.stack.append(second)
+
+    def INPLACE_SUBTRACT(self, instr):
+        first = self.frame.stack.pop()
+        second = self.frame.stack.pop()
+        second -= first
+        self.frame.stack.append(second)
+
+    def INPLACE_LSHIFT(self, instr):
+        first = self.frame.stack.pop()
+        second = self.frame.stack.pop()
+        second <<= first
+        self.frame.stack.append(second)
+
+    def INPLACE_RSHIFT(self, instr):
+        first = self.frame.stack.pop()
+        second = self.frame.stack.pop()
+        second >>= first
+        self.frame.stack.append(second)
+
+    def INPLACE_AND(self, instr):
+        first = self.frame.stack.pop()
+        second = self.frame.stack.pop()
+        second &= first
+        self.frame.stack.append(second)
+
+    def INPLACE_XOR(self, instr):
+        first = self.frame.stack.pop()
+        second = self.frame.stack.pop()
+        second ^= first
+        self.frame.stack.append(second)
+
+    def INPLACE_OR(self, instr):
+        first = self.frame.stack.pop()
+        second = self.frame.stack.pop()
+        second |= first
+        self.frame.stack.append(second)
+
+    def BINARY_OP(self, instr):
+        first = self.frame.stack.pop()
+        second = self.frame.stack.pop()
+        self.frame.stack.append(instr.argval(second, first))
+
     def DUP_TOP(self, instr):
         tos = self.frame.stack.pop()
         self.frame.stack.append(tos)
@@ -401,6 +1797,16 @@ class VirtualMachine(object):
     def POP_TOP(self, instr):
         self.frame.stack.pop()
 
+    def PUSH_NULL(self, instr):
+        self.frame.stack.append(NULL)
+
+    def COPY(self, instr):
+        self.frame.stack.append(self.frame.stack[-instr.arg])
+
+    def SWAP(self, instr):
+        stack = self.frame.stack
+        stack[-1], stack[-instr.arg] = stack[-instr.arg], stack[-1]
+
     def ROT_TWO(self, instr):
         first = self.frame.stack.pop()
         second = self.frame.stack.pop()
@@ -416,7 +1822,7 @@ class VirtualMachine(object):
         self.frame.stack.append(second)
 
     def COMPARE_OP(self, instr):
-        op = self.frame.operators[instr.argval]
+        op = instr.argval
         first = self.frame.stack.pop()
         second = self.frame.stack.pop()
         self.frame.stack.append(op(second, first))
@@ -424,44 +1830,166 @@ class VirtualMachine(object):
     def POP_JUMP_IF_FALSE(self, instr):
         tos = self.frame.stack.pop()
         if not tos:
-            self.frame.ip = instr.argval - 1
+            self.frame.ip = instr.argval
 
     def POP_JUMP_IF_TRUE(self, instr):
         tos = self.frame.stack.pop()
         if tos:
-            self.frame.ip = instr.argval - 1
+            self.frame.ip = instr.argval
+
+    def POP_JUMP_IF_NONE(self, instr):
+        tos = self.frame.stack.pop()
+        if tos is None:
+            self.frame.ip = instr.argval
+
+    def POP_JUMP_IF_NOT_NONE(self, instr):
+        tos = self.frame.stack.pop()
+        if tos is not None:
+            self.frame.ip = instr.argval
 
     def JUMP_IF_TRUE_OR_POP(self, instr):
         tos = self.frame.stack.pop()
         if tos:
             self.frame.stack.append(tos)
-            self.frame.ip = instr.argval - 1
+            self.frame.ip = instr.argval
 
     def JUMP_IF_FALSE_OR_POP(self, instr):
         tos = self.frame.stack.pop()
         if not tos:
             self.frame.stack.append(tos)
-            self.frame.ip = instr.argval - 1
+            self.frame.ip = instr.argval
 
     def JUMP_ABSOLUTE(self, instr):
-        self.frame.ip = instr.argval - 1
+        self.frame.ip = instr.argval
 
     def JUMP_FORWARD(self, instr):
-        self.frame.ip = instr.argval - 1
+        self.frame.ip = instr.argval
 
     def FOR_ITER(self, instr):
-        tos = self.frame.stack.pop()
-        try:
-            next = tos.__next__()
-            self.frame.stack.append(tos)
-            self.frame.stack.append(next)
-        except StopIteration:
-            self.frame.ip = instr.argval - 1
+        # The iterator stays on the stack; NULL as the default of next()
+        # ends the loop without raising and catching StopIteration.
+        value = next(self.frame.stack[-1], NULL)
+        if value is NULL:
+            self.frame.stack.pop()
+            self.frame.ip = instr.argval
+        else:
+            self.frame.stack.append(value)
 
     def GET_ITER(self, instr):
         tos = self.frame.stack.pop()
         self.frame.stack.append(iter(tos))
 
+    def GET_YIELD_FROM_ITER(self, instr):
+        self.frame.stack[-1] = iter(self.frame.stack[-1])
+
+    def YIELD_VALUE(self, instr):
+        return 'yield'
+
+    def YIELD_VALUE_ASYNC_GEN(self, instr):
+        self.frame.stack[-1] = AsyncGenValue(self.frame.stack[-1])
+        return 'yield'
+
+    def ASYNC_GEN_WRAP(self, instr):
+        self.frame.stack[-1] = AsyncGenValue(self.frame.stack[-1])
+
+    def YIELD_FROM(self, instr):
+        value = self.frame.stack.pop()
+        receiver = self.frame.stack[-1]
+        try:
+            if value is None:
+                result = next(receiver)
+            else:
+                result = receiver.send(value)
+        except StopIteration as stop:
+            self.frame.stack[-1] = stop.value
+            return
+        except StopAsyncIteration:
+            if not self.end_async_for():
+                raise
+            return
+        # Resumed with the next value to send, YIELD_FROM runs again.
+        self.frame.ip -= 1
+        self.frame.stack.append(result)
+        return 'yield'
+
+    def SEND(self, instr):
+        value = self.frame.stack.pop()
+        receiver = self.frame.stack[-1]
+        try:
+            if value is None:
+                result = next(receiver)
+            else:
+                result = receiver.send(value)
+        except StopIteration as stop:
+            self.frame.stack[-1] = stop.value
+            self.frame.ip = instr.argval
+            return
+        except StopAsyncIteration:
+            if not self.end_async_for():
+                raise
+            return
+        self.frame.stack.append(result)
+
+    def GET_AWAITABLE(self, instr):
+        self.frame.stack[-1] = self.get_awaitable(self.frame.stack[-1])
+
+    def GET_AITER(self, instr):
+        iterable = self.frame.stack[-1]
+        if not hasattr(type(iterable), '__aiter__'):
+            raise TypeError("'async for' requires an object with __aiter__ "
+                            "method, got {}".format(type(iterable).__name__))
+        aiter = type(iterable).__aiter__(iterable)
+        if AWAITS_AITER:
+            aiter = awaitable_result(aiter)
+        self.frame.stack[-1] = aiter
+
+    def GET_ANEXT(self, instr):
+        aiter = self.frame.stack[-1]
+        if not hasattr(type(aiter), '__anext__'):
+            raise TypeError("'async for' requires an iterator with __anext__ "
+                            "method, got {}".format(type(aiter).__name__))
+        self.frame.stack.append(
+            self.get_awaitable(type(aiter).__anext__(aiter)))
+
+    def END_ASYNC_FOR(self, instr):
+        # Only reached through exception handling, which end_async_for
+        # does in place of the VM.
+        del self.frame.stack[-2:]
+
+    def BEFORE_ASYNC_WITH(self, instr):
+        manager = self.frame.stack.pop()
+        self.frame.stack.append(manager.__aexit__)
+        self.frame.stack.append(manager.__aenter__())
+
+    def SETUP_ASYNC_WITH(self, instr):
+        self.frame.block_stack.append({'begin': instr.offset,
+                                       'end': instr.argval})
+
+    def SETUP_EXCEPT(self, instr):
+        self.frame.block_stack.append({'begin': instr.offset,
+                                       'handler': instr.argval})
+
+    # Guest code never raises into a with block's cleanup, so the cleanup
+    # instructions only see a body that completed (TOS None).
+
+    def WITH_CLEANUP_START(self, instr):
+        stack = self.frame.stack
+        stack.pop()
+        exit_func = stack.pop()
+        stack.extend([None, None, exit_func(None, None, None)])
+
+    def WITH_CLEANUP_FINISH(self, instr):
+        del self.frame.stack[-2:]
+
+    def END_FINALLY(self, instr):
+        self.frame.stack.pop()
+
+    def RETURN_GENERATOR(self, instr):
+        # The call already created the generator. This stands in for the
+        # value the first send() pushes in CPython, which the following
+        # POP_TOP drops.
+        self.frame.stack.append(None)
+
     def BUILD_LIST(self, instr):
         num_items = instr.argval
         if num_items == 0:
@@ -483,6 +2011,13 @@ class VirtualMachine(object):
             res_lst += [*iterable]
         self.frame.stack.append(res_lst)
 
+    def LIST_EXTEND(self, instr):
+        tos = self.frame.stack.pop()
+        list.extend(self.frame.stack[-instr.arg], tos)
+
+    def LIST_TO_TUPLE(self, instr):
+        self.frame.stack[-1] = tuple(self.frame.stack[-1])
+
     def BUILD_TUPLE(self, instr):
         self.BUILD_LIST(instr)
         self.frame.stack[-1] = tuple(self.frame.stack[-1])
@@ -502,22 +2037,22 @@ class VirtualMachine(object):
         self.BUILD_LIST_UNPACK(instr)
         self.frame.stack[-1] = set(self.frame.stack[-1])
 
+    def SET_UPDATE(self, instr):
+        tos = self.frame.stack.pop()
+        set.update(self.frame.stack[-instr.arg], tos)
+
     def BUILD_MAP(self, instr):
-        num_items = instr.argval
-        dct = {}
-        for i in range(num_items):
-            value = self.frame.stack.pop()
-            key = self.frame.stack.pop()
-            dct[key] = value
-        self.frame.stack.append(dct)
+        first_item = len(self.frame.stack) - 2 * instr.argval
+        items = self.frame.stack[first_item:]
+        del self.frame.stack[first_item:]
+        self.frame.stack.append(dict(zip(items[::2], items[1::2])))
 
     def BUILD_CONST_KEY_MAP(self, instr):
         keys = self.frame.stack.pop()
-        dct = {}
-        for key in reversed(keys):
-            value = self.frame.stack.pop()
-            dct[key] = value
-        self.frame.stack.append(dct)
+        first_value = len(self.frame.stack) - len(keys)
+        values = self.frame.stack[first_value:]
+        del self.frame.stack[first_value:]
+        self.frame.stack.append(dict(zip(keys, values)))
 
     def BUILD_MAP_UNPACK(self, instr):
         num_items = instr.argval
@@ -528,6 +2063,23 @@ class VirtualMachine(object):
             res_dct.update(map)
         self.frame.stack.append(res_dct)
 
+    def DICT_UPDATE(self, instr):
+        tos = self.frame.stack.pop()
+        dict.update(self.frame.stack[-instr.arg], tos)
+
+    def DICT_MERGE(self, instr):
+        tos = self.frame.stack.pop()
+        dest = self.frame.stack[-instr.arg]
+        for key in tos.keys():
+            if key in dest:
+                raise TypeError(
+                    "got multiple values for keyword argument '{}'"
+                    .format(key))
+            dest[key] = tos[key]
+
+    def BUILD_MAP_UNPACK_WITH_CALL(self, instr):
+        self.BUILD_MAP_UNPACK(instr)
+
     def UNPACK_SEQUENCE(self, instr):
         num_to_unpack = instr.argval
         sequence = self.frame.stack.pop()
@@ -557,6 +2109,21 @@ class VirtualMachine(object):
             del self.frame.stack[-3:]
             self.frame.stack.append(slice(third, second, first))
 
+    def FORMAT_VALUE(self, instr):
+        flags = instr.arg
+        fmt_spec = ''
+        if flags & 0x04:
+            fmt_spec = self.frame.stack.pop()
+        value = self.frame.stack.pop()
+        conversion = flags & 0x03
+        if conversion == 1:
+            value = str(value)
+        elif conversion == 2:
+            value = repr(value)
+        elif conversion == 3:
+            value = ascii(value)
+        self.frame.stack.append(format(value, fmt_spec))
+
     def BUILD_STRING(self, instr):
         num_strings = instr.argval
         res_str = ''.join(self.frame.stack[-num_strings:])
@@ -580,6 +2147,13 @@ class VirtualMachine(object):
         dest = self.frame.stack[-count]
         dest[key] = value
 
+    def MAP_ADD_311(self, instr):
+        count = instr.argval
+        value = self.frame.stack.pop()
+        key = self.frame.stack.pop()
+        dest = self.frame.stack[-count]
+        dest[key] = value
+
     def SETUP_LOOP(self, instr):
         block_params = {'begin': instr.offset,
                         'end': instr.argval}
@@ -587,20 +2161,24 @@ class VirtualMachine(object):
 
     def BREAK_LOOP(self, instr):
         loop_block = self.frame.block_stack.pop()
-        self.frame.ip = loop_block['end'] - 1
+        self.frame.ip = loop_block['end']
 
     def CONTINUE_LOOP(self, instr):
-        self.frame.ip = instr.argval - 1
+        self.frame.ip = instr.argval
 
     def POP_BLOCK(self, instr):
         self.frame.block_stack.pop()
 
     def MAKE_FUNCTION(self, instr):
-        flag = instr.argval
-
         func_name = self.frame.stack.pop()
         func_code = self.frame.stack.pop()
+        self.make_function(func_name, func_code, instr.argval)
+
+    def MAKE_FUNCTION_311(self, instr):
+        func_code = self.frame.stack.pop()
+        self.make_function(func_code.co_qualname, func_code, instr.argval)
 
+    def make_function(self, func_name, func_code, flag):
         closure = ()
         if flag >= 8:
             closure = self.frame.stack.pop()
@@ -610,6 +2188,9 @@ class VirtualMachine(object):
         if flag >= 4:
             annotations = self.frame.stack.pop()
             flag -= 4
+            if isinstance(annotations, tuple):
+                # 3.10+ passes a flat (name, value, ...) tuple.
+                annotations = dict(zip(annotations[::2], annotations[1::2]))
 
         kw_defaults = {}
         if flag >= 2:
@@ -630,16 +2211,96 @@ class VirtualMachine(object):
                         closure=closure)
         self.frame.stack.append(func)
 
+    def call_function(self, func, args, kwargs):
+        """Call func, pushing its result, or push its frame and return
+        'call' if it is a guest function."""
+        if type(func) is Function:
+            if not kwargs and len(args) == func.fast_arg_count:
+                args.extend(func.locals_padding)
+                return self.push_call(func, args)
+            fast_locals = func.bind_arguments(args, kwargs)
+            if func.generator_type is not None:
+                self.frame.stack.append(func.generator_type(
+                    self, self.make_frame(func.code, fast_locals,
+                                          globals=func.globals,
+                                          closure=func.closure)))
+                return
+            return self.push_call(func, fast_locals)
+        if func is builtins.__build_class__:
+            args[0] = args[0].func_obj
+        elif func is builtins.locals:
+            self.frame.stack.append(self.frame.get_locals())
+            return
+        self.frame.stack.append(func(*args, **kwargs))
+
+    def push_call(self, func, fast_locals):
+        self.push_frame(self.make_frame(func.code, fast_locals,
+                                        globals=func.globals,
+                                        closure=func.closure))
+        return 'call'
+
     def CALL_FUNCTION(self, instr):
         num_args = instr.argval
         args = []
         for i in range(num_args):
             args.append(self.frame.stack.pop())
+        args.reverse()
         func = self.frame.stack.pop()
-        if func == builtins.__build_class__:
-            args[-1] = args[-1].func_obj
-        res = func(*reversed(args))
-        self.frame.stack.append(res)
+        return self.call_function(func, args, {})
+
+    def specialize_call(self, instr, func, num_args, python_handler,
+                        native_handler):
+        if type(func) is Function and func.fast_arg_count == num_args:
+            instr.handler = python_handler
+        elif (type(func) in NATIVE_CALLABLE_TYPES and
+                func is not builtins.__build_class__ and
+                func is not builtins.locals):
+            instr.handler = native_handler
+        else:
+            instr.counter = QUICKEN_BACKOFF
+            return
+        self.specializations += 1
+
+    def deoptimize(self, instr):
+        self.specialization_misses += 1
+        instr.handler = self.adaptive_handlers[instr.opcode]
+        instr.counter = QUICKEN_BACKOFF
+        return self.dispatch_table[instr.opcode](instr)
+
+    def CALL_FUNCTION_ADAPTIVE(self, instr):
+        if instr.counter:
+            instr.counter -= 1
+        else:
+            func = self.frame.stack[-instr.arg - 1]
+            self.specialize_call(instr, func, instr.arg,
+                                 self.CALL_FUNCTION_PY_EXACT,
+                                 self.CALL_FUNCTION_NATIVE)
+        return self.CALL_FUNCTION(instr)
+
+    def CALL_FUNCTION_PY_EXACT(self, instr):
+        stack = self.frame.stack
+        first_arg = len(stack) - instr.arg
+        func = stack[first_arg - 1]
+        if type(func) is not Function or func.fast_arg_count != instr.arg:
+            return self.deoptimize(instr)
+        self.specialization_hits += 1
+        fast_locals = stack[first_arg:]
+        del stack[first_arg - 1:]
+        fast_locals.extend(func.locals_padding)
+        return self.push_call(func, fast_locals)
+
+    def CALL_FUNCTION_NATIVE(self, instr):
+        stack = self.frame.stack
+        first_arg = len(stack) - instr.arg
+        func = stack[first_arg - 1]
+        if (type(func) not in NATIVE_CALLABLE_TYPES or
+                func is builtins.__build_class__ or
+                func is builtins.locals):
+            return self.deoptimize(instr)
+        self.specialization_hits += 1
+        args = stack[first_arg:]
+        del stack[first_arg - 1:]
+        stack.append(func(*args))
 
     def CALL_FUNCTION_KW(self, instr):
         total_num_args = instr.argval
@@ -660,8 +2321,7 @@ class VirtualMachine(object):
             posargs = []
 
         func = self.frame.stack.pop()
-        res = func(*posargs, **kwargs)
-        self.frame.stack.append(res)
+        return self.call_function(func, posargs, kwargs)
 
     def CALL_FUNCTION_EX(self, instr):
         kw_present = instr.argval
@@ -670,12 +2330,93 @@ class VirtualMachine(object):
             kwargs = self.frame.stack.pop()
         posargs = self.frame.stack.pop()
         func = self.frame.stack.pop()
-        func_res = func(*posargs, **kwargs)
-        self.frame.stack.append(func_res)
+        return self.call_function(func, list(posargs), kwargs)
+
+    def CALL_FUNCTION_EX_311(self, instr):
+        # As CALL_FUNCTION_EX, with a NULL below the callable.
+        kwargs = {}
+        if instr.arg & 1:
+            kwargs = self.frame.stack.pop()
+        posargs = self.frame.stack.pop()
+        func = self.frame.stack.pop()
+        self.frame.stack.pop()
+        return self.call_function(func, list(posargs), kwargs)
+
+    def CALL(self, instr):
+        # Below the arguments is either NULL and the callable, or the
+        # callable and its self argument (see LOAD_METHOD).
+        stack = self.frame.stack
+        num_args = instr.arg
+        args = stack[len(stack) - num_args:]
+        del stack[len(stack) - num_args:]
+        if stack[-2] is NULL:
+            func = stack[-1]
+        else:
+            func = stack[-2]
+            args.insert(0, stack[-1])
+        del stack[-2:]
+
+        kwargs = {}
+        kw_names = instr.argval
+        if kw_names:
+            kwargs_values = args[-len(kw_names):]
+            del args[-len(kw_names):]
+            kwargs = dict(zip(kw_names, kwargs_values))
+        return self.call_function(func, args, kwargs)
+
+    def CALL_ADAPTIVE(self, instr):
+        if instr.counter:
+            instr.counter -= 1
+        elif instr.argval:
+            # Keyword calls always take the generic path.
+            instr.counter = QUICKEN_BACKOFF
+        else:
+            stack = self.frame.stack
+            first_arg = len(stack) - instr.arg
+            func = stack[first_arg - 2]
+            num_args = instr.arg + 1
+            if func is NULL:
+                func = stack[first_arg - 1]
+                num_args -= 1
+            self.specialize_call(instr, func, num_args,
+                                 self.CALL_PY_EXACT, self.CALL_NATIVE)
+        return self.CALL(instr)
+
+    def CALL_PY_EXACT(self, instr):
+        stack = self.frame.stack
+        first_arg = len(stack) - instr.arg
+        func = stack[first_arg - 2]
+        if func is NULL:
+            func = stack[first_arg - 1]
+        else:
+            first_arg -= 1
+        if (type(func) is not Function or
+                func.fast_arg_count != len(stack) - first_arg):
+            return self.deoptimize(instr)
+        self.specialization_hits += 1
+        fast_locals = stack[first_arg:]
+        del stack[len(stack) - instr.arg - 2:]
+        fast_locals.extend(func.locals_padding)
+        return self.push_call(func, fast_locals)
+
+    def CALL_NATIVE(self, instr):
+        stack = self.frame.stack
+        first_arg = len(stack) - instr.arg
+        func = stack[first_arg - 2]
+        if func is NULL:
+            func = stack[first_arg - 1]
+        else:
+            first_arg -= 1
+        if (type(func) not in NATIVE_CALLABLE_TYPES or
+                func is builtins.__build_class__ or
+                func is builtins.locals):
+            return self.deoptimize(instr)
+        self.specialization_hits += 1
+        args = stack[first_arg:]
+        del stack[len(stack) - instr.arg - 2:]
+        stack.append(func(*args))
 
     def RETURN_VALUE(self, instr):
-        return_value = self.frame.stack.pop()
-        self.frame_stack.append(return_value)
         return 'return'
 
     def IMPORT_NAME(self, instr):
@@ -693,6 +2434,7 @@ class VirtualMachine(object):
 
     def IMPORT_STAR(self, instr):
         module = self.frame.stack.pop()
+        self.bump_namespace_version()
         for name in module.__dict__:
             if name.startswith('_'):
                 continue
@@ -705,6 +2447,126 @@ class VirtualMachine(object):
     def POP_EXCEPT(self, instr):
         pass
 
+    # Superinstructions: each runs the sequence its SUPERINSTRUCTIONS key
+    # names, reading the tail instructions through next_instr.
+
+    def LOAD_FAST__LOAD_FAST(self, instr):
+        fast_locals = self.frame.fast_locals
+        second_instr = instr.next_instr
+        first = fast_locals[instr.arg]
+        if first is NULL:
+            self.unbound_local(instr)
+        second = fast_locals[second_instr.arg]
+        if second is NULL:
+            self.unbound_local(second_instr)
+        self.frame.stack.append(first)
+        self.frame.stack.append(second)
+        self.frame.ip += 1
+
+    def LOAD_FAST__LOAD_CONST(self, instr):
+        value = self.frame.fast_locals[instr.arg]
+        if value is NULL:
+            self.unbound_local(instr)
+        self.frame.stack.append(value)
+        self.frame.stack.append(instr.next_instr.argval)
+        self.frame.ip += 1
+
+    def LOAD_FAST__LOAD_ATTR(self, instr):
+        value = self.frame.fast_locals[instr.arg]
+        if value is NULL:
+            self.unbound_local(instr)
+        self.frame.stack.append(getattr(value, instr.next_instr.argval))
+        self.frame.ip += 1
+
+    def STORE_FAST__LOAD_FAST(self, instr):
+        fast_locals = self.frame.fast_locals
+        load_instr = instr.next_instr
+        fast_locals[instr.arg] = self.frame.stack.pop()
+        value = fast_locals[load_instr.arg]
+        if value is NULL:
+            self.unbound_local(load_instr)
+        self.frame.stack.append(value)
+        self.frame.ip += 1
+
+    def STORE_FAST__STORE_FAST(self, instr):
+        fast_locals = self.frame.fast_locals
+        fast_locals[instr.arg] = self.frame.stack.pop()
+        fast_locals[instr.next_instr.arg] = self.frame.stack.pop()
+        self.frame.ip += 1
+
+    def FOR_ITER__STORE_FAST(self, instr):
+        value = next(self.frame.stack[-1], NULL)
+        if value is NULL:
+            self.frame.stack.pop()
+            self.frame.ip = instr.argval
+        else:
+            self.frame.fast_locals[instr.next_instr.arg] = value
+            self.frame.ip += 1
+
+    def FOR_ITER__STORE_NAME(self, instr):
+        value = next(self.frame.stack[-1], NULL)
+        if value is NULL:
+            self.frame.stack.pop()
+            self.frame.ip = instr.argval
+        else:
+            name = instr.next_instr.argval
+            if name not in self.frame.locals:
+                self.bump_namespace_version()
+            self.frame.locals[name] = value
+            self.frame.ip += 1
+
+    def COMPARE_OP__POP_JUMP_IF_FALSE(self, instr):
+        first = self.frame.stack.pop()
+        second = self.frame.stack.pop()
+        if instr.argval(second, first):
+            self.frame.ip += 1
+        else:
+            self.frame.ip = instr.next_instr.argval
+
+    def COMPARE_OP__POP_JUMP_IF_TRUE(self, instr):
+        first = self.frame.stack.pop()
+        second = self.frame.stack.pop()
+        if instr.argval(second, first):
+            self.frame.ip = instr.next_instr.argval
+        else:
+            self.frame.ip += 1
+
+    def LOAD_FAST__LOAD_FAST__COMPARE_OP__POP_JUMP_IF_FALSE(self, instr):
+        fast_locals = self.frame.fast_locals
+        second_instr = instr.next_instr
+        compare_instr = second_instr.next_instr
+        first = fast_locals[instr.arg]
+        if first is NULL:
+            self.unbound_local(instr)
+        second = fast_locals[second_instr.arg]
+        if second is NULL:
+            self.unbound_local(second_instr)
+        if compare_instr.argval(first, second):
+            self.frame.ip += 3
+        else:
+            self.frame.ip = compare_instr.next_instr.argval
+
+    def LOAD_FAST__LOAD_CONST__BINARY_OP(self, instr):
+        value = self.frame.fast_locals[instr.arg]
+        if value is NULL:
+            self.unbound_local(instr)
+        const_instr = instr.next_instr
+        operation = const_instr.next_instr.argval
+        self.frame.stack.append(operation(value, const_instr.argval))
+        self.frame.ip += 2
+
+    def LOAD_FAST__LOAD_CONST__BINARY_OP__STORE_FAST(self, instr):
+        fast_locals = self.frame.fast_locals
+        value = fast_locals[instr.arg]
+        if value is NULL:
+            self.unbound_local(instr)
+        const_instr = instr.next_instr
+        binary_instr = const_instr.next_instr
+        store_instr = binary_instr.next_instr
+        fast_locals[store_instr.arg] = binary_instr.argval(
+            value, const_instr.argval)
+        self.frame.ip += 3
+
     def RAISE_VARARGS(self, instr):
         num_args = instr.argval
         if num_args == 1:
@@ -725,4 +2587,4 @@ class VirtualMachine(object):
 
 if __name__ == '__main__':
     vm = VirtualMachine()
-    run_vm(vm)
+    run_vm(vm, report_path=sys.argv[1] if len(sys.argv) > 1 else None)